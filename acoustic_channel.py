@@ -0,0 +1,236 @@
+__author__ = 'nick'
+
+# Bandwidth limited acoustic modem link. Messages are serialized one after the other at the bit rate of the link
+# according to their encoded size and then propagate with the delay of the pipe. The transmit queue is bounded,
+# put() rejects messages while it is full and send() waits for room (backpressure), and a seeded fraction of the
+# transmitted messages is lost. The channel keeps the counters to report utilization, queueing delay and throughput.
+
+import argparse
+from collections import deque
+import pickle
+import numpy as np
+import simpy
+
+from pipe import Pipe
+from msgs import *
+
+# Encoded sizes in bytes
+HEADER_SIZE = 8  # Type, source, version and checksum
+ID_SIZE = 2
+POS_SIZE = 12  # Three float32
+CLASS_SIZE = 1
+OP_SIZE = 1
+
+
+def message_size(msg):
+    """
+    Size of the compact binary encoding of a message: ids as uint16, positions as three float32. Targets the
+    receiver does not know yet are sent with their position, the others by id.
+    :return: Size in bytes.
+    """
+    if isinstance(msg, PlanReqMsg):
+        return HEADER_SIZE + len(msg.target_list) * (ID_SIZE + POS_SIZE) + len(msg.target_order) * ID_SIZE
+    if isinstance(msg, PlanDeltaMsg):
+        size = HEADER_SIZE + ID_SIZE  # Base version
+        for op in msg.ops:
+            if op[0] == PLAN_INSERT:
+                size += OP_SIZE + ID_SIZE + POS_SIZE + ID_SIZE
+            elif op[0] == PLAN_REMOVE:
+                size += OP_SIZE + ID_SIZE
+            else:
+                size += OP_SIZE + ID_SIZE + len(op[1]) * ID_SIZE
+        return size
+    if isinstance(msg, PlanFeedbackMsg):
+        return HEADER_SIZE + ID_SIZE + CLASS_SIZE
+    if isinstance(msg, NavReqMsg):
+        return HEADER_SIZE
+    if isinstance(msg, NavUpdateMsg):
+        return HEADER_SIZE + POS_SIZE
+    return HEADER_SIZE + len(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+
+
+class AcousticChannel(Pipe):
+    """
+    Pipe with a bandwidth limited, lossy transmitter in front of the propagation delay.
+    """
+
+    def __init__(self, env, delay, bandwidth=1200.0, queue_size=None, loss=0.0, seed=None, size=message_size,
+                 batch=False):
+        """
+        :param env: SimPy environment.
+        :param delay: Propagation delay in seconds.
+        :param bandwidth: Bit rate of the link in bits per second.
+        :param queue_size: Maximum number of messages waiting or in transmission, None for unbounded.
+        :param loss: Probability that a transmitted message is lost.
+        :param seed: Seed of the losses.
+        :param size: Function that gives the encoded size of a message in bytes.
+        :param batch: See Pipe.
+        """
+        Pipe.__init__(self, env, delay, batch)
+        self.bandwidth = bandwidth
+        self.queue_size = queue_size
+        self.loss = loss
+        self.rng = np.random.RandomState(seed)
+        self.size = size
+        self.busy_until = env.now  # End of the transmission of the last queued message
+        self.transmissions = deque()  # End times of the transmissions not finished yet
+        self.senders = deque()  # (event, message, delay, send time) of the send() calls waiting for room
+        self.start_time = env.now
+        # Counters
+        self.sent = 0
+        self.rejected = 0
+        self.lost = 0
+        self.bytes_sent = 0
+        self.bytes_delivered = 0
+        self.busy_time = 0.0
+        self.queueing_delay = 0.0
+        self.max_queueing_delay = 0.0
+
+    def queued(self):
+        """
+        :return: Number of messages waiting or in transmission.
+        """
+        while self.transmissions and self.transmissions[0] <= self.env.now:
+            self.transmissions.popleft()
+        return len(self.transmissions)
+
+    def full(self):
+        return self.queue_size is not None and self.queued() >= self.queue_size
+
+    def put(self, value, delay=None):
+        """
+        Queues a message for transmission.
+        :param value: Message.
+        :param delay: Optional propagation delay of this message, the delay of the channel by default.
+        :return: False if the queue was full and the message was rejected.
+        """
+        if self.senders or self.full():
+            self.rejected += 1
+            return False
+        self._transmit(value, delay, self.env.now)
+        return True
+
+    def _transmit(self, value, delay, queued_at):
+        size = self.size(value)
+        start = max(self.env.now, self.busy_until)
+        tx_time = 8.0 * size / self.bandwidth
+        self.busy_until = start + tx_time
+        self.transmissions.append(self.busy_until)
+        self.sent += 1
+        self.bytes_sent += size
+        self.busy_time += tx_time
+        self.queueing_delay += start - queued_at
+        self.max_queueing_delay = max(self.max_queueing_delay, start - queued_at)
+        if self.loss > 0 and self.rng.random_sample() < self.loss:
+            # The message still occupies the link
+            self.lost += 1
+        else:
+            self.bytes_delivered += size
+            propagation = self.delay if delay is None else delay
+            Pipe.put(self, value, self.busy_until + propagation - self.env.now)
+
+    def send(self, value, delay=None):
+        """
+        Queues a message for transmission, waiting for room when the queue is full, for senders that must not lose
+        messages to backpressure. Waiting messages are queued in the order they were sent and put() rejects messages
+        while any are waiting.
+        :param value: Message.
+        :param delay: Optional propagation delay of this message, the delay of the channel by default.
+        :return: An event that succeeds once the message is queued.
+        """
+        event = self.env.event()
+        if not self.senders and not self.full():
+            self._transmit(value, delay, self.env.now)
+            event.succeed()
+        else:
+            if not self.senders:
+                self._wait_space()
+            self.senders.append((event, value, delay, self.env.now))
+        return event
+
+    def _wait_space(self):
+        timeout = self.env.timeout(self.transmissions[0] - self.env.now)
+        timeout.callbacks.append(self._release_space)
+
+    def _release_space(self, event):
+        while self.senders and not self.full():
+            sent, value, delay, queued_at = self.senders.popleft()
+            self._transmit(value, delay, queued_at)
+            sent.succeed()
+        if self.senders:
+            self._wait_space()
+
+    def stats(self):
+        """
+        :return: A dictionary with the counters, the utilization of the link (fraction of the time transmitting),
+        the mean queueing delay in seconds and the throughput in delivered bits per second, since the channel was
+        created.
+        """
+        elapsed = self.env.now - self.start_time
+        # Transmissions that go on after now do not count yet
+        busy = self.busy_time - max(0.0, self.busy_until - self.env.now)
+        return {'sent': self.sent, 'rejected': self.rejected, 'lost': self.lost, 'bytes_sent': self.bytes_sent,
+                'queued': self.queued(), 'waiting': len(self.senders),
+                'utilization': busy / elapsed if elapsed > 0 else 0.0,
+                'mean_queueing_delay': self.queueing_delay / self.sent if self.sent > 0 else 0.0,
+                'max_queueing_delay': self.max_queueing_delay,
+                'throughput': 8.0 * self.bytes_delivered / elapsed if elapsed > 0 else 0.0}
+
+    def get_state(self):
+        """
+        :return: The pending messages, the messages waiting in send() and the transmitter state. Counters restart
+        with the restored channel.
+        """
+        return {'pending': Pipe.get_state(self), 'waiting': [(value, delay) for event, value, delay, t in self.senders],
+                'busy_until': self.busy_until,
+                'transmissions': list(self.transmissions), 'rng': self.rng.get_state()}
+
+    def set_state(self, state):
+        # The pending messages were already transmitted
+        for t, value in state['pending']:
+            Pipe.put(self, value, max(0, t - self.env.now))
+        self.busy_until = state['busy_until']
+        self.transmissions = deque(state['transmissions'])
+        self.rng.set_state(state['rng'])
+        # Nobody waits for the send events of the restored messages
+        for value, delay in state['waiting']:
+            self.send(value, delay)
+
+
+def main():
+    from sim_auv import AuvExecutor, TargetGenerator
+    from bench_sim import random_targets
+
+    parser = argparse.ArgumentParser(description='Generator mission over an acoustic link at several bit rates.')
+    parser.add_argument('--bandwidths', type=float, nargs='+', default=[80, 300, 1200, 9600])
+    parser.add_argument('--targets', type=int, default=50)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--queue-size', type=int, default=None, help='Transmit queue size of the plan channel.')
+    parser.add_argument('--period', type=float, default=120.0, help='Target generation period in seconds.')
+    parser.add_argument('--until', type=float, default=12 * 3600)
+    args = parser.parse_args()
+
+    for use_deltas in (False, True):
+        for bandwidth in args.bandwidths:
+            env = simpy.Environment()
+            plan_request = AcousticChannel(env, 1.0, bandwidth, args.queue_size, loss=args.loss, seed=0)
+            plan_feedback = AcousticChannel(env, 1.0, bandwidth, loss=args.loss, seed=1)
+            nav_req = AcousticChannel(env, 1.0, bandwidth, loss=args.loss, seed=2)
+            nav_update = AcousticChannel(env, 1.0, bandwidth, loss=args.loss, seed=3)
+            auv = AuvExecutor(env, "auv", plan_request, plan_feedback, nav_req, nav_update)
+            generator = TargetGenerator(env, plan_request, plan_feedback, nav_req, nav_update,
+                                        targets=random_targets(args.targets))
+            generator.use_deltas = use_deltas
+            generator.engine = 'heuristic'
+            generator.generation_period = args.period
+            env.run(until=args.until)
+            s = plan_request.stats()
+            print('%-6s %6g bps: %4d plans %3d rejected %7d bytes, utilization %5.1f%%, '
+                  'queueing mean %7.2fs max %7.2fs, %d inspections, %d stale deltas' % (
+                      'delta' if use_deltas else 'full', bandwidth, s['sent'], s['rejected'], s['bytes_sent'],
+                      100 * s['utilization'], s['mean_queueing_delay'], s['max_queueing_delay'], auv.inspections,
+                      auv.plan_mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+__author__ = 'nick'
+
+# Benchmark of the OVRP engines on random and clustered instances of increasing size. Every engine is run through
+# solve_ovrp and the results are appended to a JSON lines file, one record per instance and engine.
+
+import argparse
+import json
+import time
+import numpy as np
+from cost_matrix import distance_matrix
+from ovrp_solver import solve_ovrp, OvrpModel, HAS_GUROBI
+
+SIZES = (10, 20, 50, 100, 200, 500, 1000)
+MILP_MAX_SIZE = {'milp': 50, 'lazy': 200, 'warm': 50}  # Larger instances take too long for the exact engines
+
+
+def random_instance(n, dim=3, extent=1000.0, seed=0):
+    """
+    Uniformly distributed points in NED. Depth is kept positive and smaller than the horizontal extent.
+    :return: Array of shape (n, dim).
+    """
+    rng = np.random.RandomState(seed)
+    points = rng.uniform(-extent, extent, (n, dim))
+    if dim == 3:
+        points[:, 2] = rng.uniform(0, extent / 20, n)
+    return points
+
+
+def clustered_instance(n, dim=3, extent=1000.0, clusters=5, spread=50.0, seed=0):
+    """
+    Points drawn around a few random centres, as targets found by a survey usually are.
+    :return: Array of shape (n, dim).
+    """
+    rng = np.random.RandomState(seed)
+    centres = random_instance(clusters, dim, extent, seed + 1)
+    points = centres[rng.randint(clusters, size=n)] + rng.normal(0, spread, (n, dim))
+    if dim == 3:
+        points[:, 2] = np.abs(points[:, 2])
+    return points
+
+
+def engines():
+    return ['milp', 'lazy', 'warm', 'heuristic'] if HAS_GUROBI else ['heuristic']
+
+
+def run_engine(engine, cost, time_limit=None):
+    """
+    Solves one instance with one engine through solve_ovrp.
+    :return: A dictionary with the engine that actually solved the instance, which is the heuristic when the MILP
+    failed and solve_ovrp fell back to it, the build time, solve time, objective and MIP gap (None when not
+    available).
+    """
+    warm_model = OvrpModel() if engine == 'warm' else None
+    keys = list(range(cost.shape[0]))
+    if warm_model is not None:
+        # Warm the model up on the instance without its last point, like a replan after a new target
+        solve_ovrp(cost[:-1, :-1], engine=engine, keys=keys[:-1], warm_model=warm_model, time_limit=time_limit)
+    st = time.time()
+    route, total_cost, model = solve_ovrp(cost, engine=engine, keys=keys, warm_model=warm_model,
+                                          time_limit=time_limit)
+    total_time = time.time() - st
+    build_time = getattr(model, '_build_time', 0.0) if model is not None else 0.0
+    solve_time = getattr(model, '_solve_time', total_time - build_time) if model is not None else total_time
+    gap = model.MIPGap if model is not None and hasattr(model, 'MIPGap') else None
+    # Only the heuristic returns no model
+    return {'engine': engine if model is not None else 'heuristic', 'build_time': build_time,
+            'solve_time': solve_time, 'total_time': total_time, 'objective': float(total_cost), 'mip_gap': gap,
+            'route_length': int(len(route))}
+
+
+def run(sizes=SIZES, dims=(2, 3), kinds=('random', 'clustered'), seed=0, time_limit=None, output=None):
+    """
+    Runs every available engine on every instance.
+    :param output: Optional path of a JSON lines file the records are appended to.
+    :return: The list of records. The gap is relative to the best objective found for the instance.
+    """
+    records = []
+    for kind in kinds:
+        for dim in dims:
+            for n in sizes:
+                if kind == 'random':
+                    points = random_instance(n, dim, seed=seed)
+                else:
+                    points = clustered_instance(n, dim, seed=seed)
+                cost = distance_matrix(points)
+                instance = []
+                for engine in engines():
+                    if n > MILP_MAX_SIZE.get(engine, n):
+                        continue
+                    record = {'instance': kind, 'dim': dim, 'n': n, 'seed': seed, 'requested_engine': engine}
+                    record.update(run_engine(engine, cost, time_limit))
+                    instance.append(record)
+                best = min(r['objective'] for r in instance)
+                for r in instance:
+                    r['gap'] = (r['objective'] - best) / best if best > 0 else 0.0
+                    fallback = ' (%s failed)' % r['requested_engine'] if r['engine'] != r['requested_engine'] else ''
+                    print('%-9s %dD n=%-5d %-9s build %.3fs solve %.3fs cost %.1f gap %.2f%%%s' % (
+                        kind, dim, n, r['engine'], r['build_time'], r['solve_time'], r['objective'],
+                        100 * r['gap'], fallback))
+                records.extend(instance)
+    if output is not None:
+        with open(output, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OVRP engines.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--dims', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-limit', type=float, default=None)
+    parser.add_argument('--output', default='bench_ovrp.jsonl')
+    args = parser.parse_args()
+    run(args.sizes, args.dims, seed=args.seed, time_limit=args.time_limit, output=args.output)
+
+
+if __name__ == '__main__':
+    main()
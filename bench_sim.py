@@ -0,0 +1,283 @@
+__author__ = 'nick'
+
+# Throughput benchmark and soak test of the simulation. Scenarios drive the Pipe classes, AuvExecutor with
+# TargetGenerator, AuvExecutor with AuvPlanner and FleetExecutor with FleetPlanner at increasing scale: number of
+# vehicles, number of targets per vehicle, simulated duration and message rate, one axis at a time around a base case.
+# Every case runs in a fresh worker process so that the peak RSS belongs to that case only. Soak runs trace the
+# allocations with tracemalloc while the simulation advances in chunks and report how much the traced memory grows
+# after the first chunk. The records are appended to a JSON lines file and compare() shows the change of the
+# throughput against the previous run of each case.
+
+import argparse
+import json
+import resource
+import subprocess
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import simpy
+
+from pipe import Pipe
+from msgs import *
+
+SCENARIOS = ('pipe', 'generator', 'planner', 'fleet')
+VEHICLES = (1, 10, 100)
+TARGETS = (20, 100, 500)  # Targets per vehicle
+DURATIONS = (6 * 3600, 24 * 3600, 72 * 3600)
+BASE_VEHICLES = 10  # Number of vehicles of the target, duration and message rate sweeps
+SOAK_CHUNKS = 10
+
+
+class CountingEnvironment(simpy.Environment):
+    """
+    Environment that counts the processed events.
+    """
+
+    def __init__(self, initial_time=0):
+        simpy.Environment.__init__(self, initial_time)
+        self.events = 0
+
+    def step(self):
+        self.events += 1
+        simpy.Environment.step(self)
+
+
+class PipeLoad:
+    """
+    A sender that puts a message every period seconds and a receiver subscribed to the pipe like the simulation
+    components are.
+    """
+
+    def __init__(self, env, delay, period):
+        self.env = env
+        self.period = period
+        self.pipe = Pipe(env, delay)
+        self.received = 0
+        self.pipe.subscribe(self.handle_msg)
+        self.action = env.process(self.run())
+
+    def handle_msg(self, msg):
+        self.received += 1
+
+    def run(self):
+        while True:
+            self.pipe.put(NavUpdateMsg([0, 0, 0]))
+            yield self.env.timeout(self.period)
+
+
+def random_targets(n, extent=500.0, seed=0):
+    rng = np.random.RandomState(seed)
+    targets = rng.uniform(-extent, extent, (n, 3))
+    targets[:, 2] = rng.uniform(0, extent / 10, n)
+    return targets.tolist()
+
+
+def build(env, scenario, vehicles, targets, period, delay, seed=0):
+    """
+    Creates the components of a scenario, one independent mission per vehicle. The fleet scenario is one mission
+    with all the targets, planned by FleetPlanner over an area that grows with the number of vehicles.
+    :param period: Message period of the pipe scenario and target generation period of the generator scenario.
+    :param delay: Delay of the pipes.
+    :return: The executors, or the pipe loads for the pipe scenario.
+    """
+    from sim_auv import AuvExecutor, TargetGenerator
+    from sim_auv_planner import AuvPlanner, FleetPlanner
+    from fleet_executor import FleetExecutor
+
+    if scenario == 'fleet':
+        pipes = [[Pipe(env, delay) for i in range(vehicles)] for k in range(4)]
+        positions = random_targets(vehicles * targets, extent=500.0 * np.sqrt(vehicles), seed=seed)
+        FleetPlanner(env, *pipes, targets=positions, engine='heuristic', workers=0)
+        return [FleetExecutor(env, vehicles, None, *pipes)]
+    components = []
+    for i in range(vehicles):
+        if scenario == 'pipe':
+            components.append(PipeLoad(env, delay, period))
+            continue
+        plan_request = Pipe(env, delay)
+        plan_feedback = Pipe(env, delay)
+        nav_req = Pipe(env, delay)
+        nav_update = Pipe(env, delay)
+        auv = AuvExecutor(env, "auv%d" % i, plan_request, plan_feedback, nav_req, nav_update)
+        positions = random_targets(targets, seed=seed + i)
+        if scenario == 'generator':
+            generator = TargetGenerator(env, plan_request, plan_feedback, nav_req, nav_update, targets=positions)
+            generator.engine = 'heuristic'
+            generator.generation_period = period
+        else:
+            AuvPlanner(env, plan_request, plan_feedback, nav_req, nav_update, engine='heuristic', targets=positions)
+        components.append(auv)
+    return components
+
+
+def peak_rss():
+    """
+    :return: Peak resident set size of the process in MB.
+    """
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_case(case):
+    """
+    Runs one benchmark case, meant to be executed in a fresh worker process.
+    :param case: Dictionary with scenario, vehicles, targets, period, delay, duration and soak.
+    :return: The case updated with the measurements.
+    """
+    env = CountingEnvironment()
+    st = time.time()
+    build(env, case['scenario'], case['vehicles'], case['targets'], case['period'], case['delay'])
+    build_time = time.time() - st
+
+    record = dict(case)
+    if case['soak']:
+        tracemalloc.start()
+        memory = []
+        st = time.time()
+        for k in range(1, SOAK_CHUNKS + 1):
+            env.run(until=case['duration'] * k / SOAK_CHUNKS)
+            memory.append(tracemalloc.get_traced_memory()[0])
+        wall_time = time.time() - st
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # Growth after the first chunk, the first chunk includes the warm up of the mission
+        record.update({'traced_memory': memory, 'traced_peak_mb': peak_traced / 2.0 ** 20,
+                       'traced_growth_mb': (memory[-1] - memory[0]) / 2.0 ** 20})
+    else:
+        st = time.time()
+        env.run(until=case['duration'])
+        wall_time = time.time() - st
+    record.update({'build_time': build_time, 'wall_time': wall_time, 'events': env.events,
+                   'events_per_sec': env.events / wall_time if wall_time > 0 else float('inf'),
+                   'speedup': case['duration'] / wall_time if wall_time > 0 else float('inf'),
+                   'peak_rss_mb': peak_rss()})
+    return record
+
+
+def make_case(scenario, vehicles, targets=20, period=10.0, delay=0, duration=24 * 3600, soak=False):
+    return {'scenario': scenario, 'vehicles': vehicles, 'targets': targets, 'period': period, 'delay': delay,
+            'duration': duration, 'soak': soak}
+
+
+def throughput_cases(vehicles=VEHICLES, targets=TARGETS, durations=DURATIONS, duration=24 * 3600):
+    """
+    :param vehicles: Numbers of vehicles of the vehicle sweep.
+    :param targets: Numbers of targets per vehicle of the target sweep, for the mission scenarios.
+    :param durations: Simulated durations of the duration sweep.
+    :param duration: Simulated duration of the other sweeps.
+    :return: The cases, without duplicates.
+    """
+    cases = []
+
+    def __add(case):
+        if case_key(case) not in [case_key(c) for c in cases]:
+            cases.append(case)
+
+    for scenario in SCENARIOS:
+        for n in vehicles:
+            __add(make_case(scenario, n, duration=duration))
+        if scenario != 'pipe':
+            for n in targets:
+                __add(make_case(scenario, BASE_VEHICLES, targets=n, duration=duration))
+        for d in durations:
+            __add(make_case(scenario, BASE_VEHICLES, duration=d))
+    # Message rate and delay of the pipes, over a tenth of the duration, 0.1 s periods make 25M events in 24 hours
+    for period in (1.0, 0.1):
+        for delay in (0, 1):
+            __add(make_case('pipe', BASE_VEHICLES, period=period, delay=delay, duration=duration / 10))
+    return cases
+
+
+def soak_cases(duration=7 * 24 * 3600):
+    return [make_case(scenario, 10, targets=100, duration=duration, soak=True) for scenario in SCENARIOS]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(record):
+    return tuple(record[k] for k in ('scenario', 'vehicles', 'targets', 'period', 'delay', 'duration', 'soak'))
+
+
+def run(cases, output=None, isolate=True):
+    """
+    Runs the cases one after the other.
+    :param output: Optional path of a JSON lines file the records are appended to.
+    :param isolate: Run every case in a fresh process so that the peak RSS is per case.
+    :return: The list of records.
+    """
+    revision = git_revision()
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    for case in cases:
+        if isolate:
+            with ProcessPoolExecutor(1) as pool:
+                record = pool.submit(run_case, case).result()
+        else:
+            record = run_case(case)
+        record.update({'revision': revision, 'time': stamp, 'simpy': simpy.__version__})
+        records.append(record)
+        line = '%-9s veh=%-4d tgt=%-4d dur=%-7g period=%-5g delay=%-3g %8d events %10.0f ev/s %8.0fx rss %6.1fMB' % (
+            record['scenario'], record['vehicles'], record['targets'], record['duration'], record['period'],
+            record['delay'], record['events'], record['events_per_sec'], record['speedup'], record['peak_rss_mb'])
+        if record['soak']:
+            line += ' growth %.3fMB' % record['traced_growth_mb']
+        print(line)
+    if output is not None:
+        with open(output, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+    return records
+
+
+def compare(path):
+    """
+    Compares the last run of every case in a results file with the run before.
+    :return: A list of (case, previous events per second, last events per second, ratio).
+    """
+    history = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            history.setdefault(case_key(record), []).append(record)
+    rows = []
+    for key, records in history.items():
+        if len(records) > 1:
+            previous = records[-2]['events_per_sec']
+            last = records[-1]['events_per_sec']
+            rows.append((key, previous, last, last / previous if previous > 0 else float('nan')))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the simulation throughput.')
+    parser.add_argument('--soak', action='store_true', help='Run the long soak cases with tracemalloc.')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=list(VEHICLES))
+    parser.add_argument('--targets', type=int, nargs='+', default=list(TARGETS))
+    parser.add_argument('--durations', type=float, nargs='+', default=list(DURATIONS),
+                        help='Simulated durations of the duration sweep in seconds.')
+    parser.add_argument('--duration', type=float, default=None, help='Simulated duration in seconds.')
+    parser.add_argument('--output', default='bench_sim.jsonl')
+    parser.add_argument('--compare', action='store_true', help='Compare the last two runs in the output file.')
+    args = parser.parse_args()
+
+    if args.compare:
+        for key, previous, last, ratio in compare(args.output):
+            print('%-60s %10.0f -> %10.0f ev/s (%+.1f%%)' % (key, previous, last, 100 * (ratio - 1)))
+        return
+    if args.soak:
+        cases = soak_cases() if args.duration is None else soak_cases(args.duration)
+    else:
+        kwargs = {} if args.duration is None else {'duration': args.duration}
+        cases = throughput_cases(args.vehicles, args.targets, args.durations, **kwargs)
+    run(cases, args.output)
+
+
+if __name__ == '__main__':
+    main()
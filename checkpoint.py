@@ -0,0 +1,104 @@
+__author__ = 'nick'
+
+# Checkpoint and resume of simulations. SimPy processes are generators and can not be saved, so every component
+# (Pipe, AuvExecutor, TargetGenerator, AuvPlanner) exports the data it needs to continue with get_state() and a new
+# component built on a simpy.Environment starting at the snapshot time takes it back with set_state(). The states of
+# all components are copied together so that objects shared between them, e.g. the targets of the planner registry
+# and of the executor plan, stay shared after the restore.
+
+import argparse
+import copy
+import pickle
+import time
+import simpy
+
+from pipe import Pipe
+
+
+def snapshot(env, components):
+    """
+    Takes a snapshot of a running simulation, e.g. after env.run(until=t).
+    :param env: SimPy environment.
+    :param components: Dictionary from a name to a component with get_state().
+    :return: The snapshot, a copy that later steps of the simulation do not change.
+    """
+    states = dict((name, component.get_state()) for name, component in components.items())
+    return {'time': env.now, 'states': copy.deepcopy(states)}
+
+
+def save(snap, path):
+    with open(path, 'wb') as f:
+        pickle.dump(snap, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def restore(snap, build):
+    """
+    Rebuilds a simulation from a snapshot.
+    :param snap: Snapshot of snapshot() or load().
+    :param build: Function that creates the components on an environment and returns them by name, with the same
+    names as when the snapshot was taken. Components can be swapped, e.g. another planner, as long as they accept
+    the state.
+    :return: The new environment, starting at the snapshot time, and the components.
+    """
+    env = simpy.Environment(initial_time=snap['time'])
+    components = build(env)
+    # The snapshot can be restored more than once
+    states = copy.deepcopy(snap['states'])
+    for name, state in states.items():
+        components[name].set_state(state)
+    return env, components
+
+
+def build_mission(env, mode='planner', targets=None, delay=0):
+    """
+    The single vehicle mission of sim_auv and sim_auv_planner.
+    :param mode: 'planner' for AuvPlanner or 'generator' for TargetGenerator.
+    :param targets: Optional target positions.
+    :return: The components by name.
+    """
+    from sim_auv import AuvExecutor, TargetGenerator
+    from sim_auv_planner import AuvPlanner
+
+    components = {'plan_request': Pipe(env, delay), 'plan_feedback': Pipe(env, delay), 'nav_req': Pipe(env, delay),
+                  'nav_update': Pipe(env, delay)}
+    pipes = [components[name] for name in ('plan_request', 'plan_feedback', 'nav_req', 'nav_update')]
+    components['auv'] = AuvExecutor(env, "auv", *pipes)
+    if mode == 'planner':
+        components['planner'] = AuvPlanner(env, *pipes, engine='heuristic', targets=targets)
+    else:
+        components['generator'] = TargetGenerator(env, *pipes, targets=targets)
+    return components
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a mission, take a snapshot and resume it.')
+    parser.add_argument('--mode', choices=['planner', 'generator'], default='generator')
+    parser.add_argument('--at', type=float, default=500.0, help='Snapshot time.')
+    parser.add_argument('--until', type=float, default=3600.0)
+    parser.add_argument('--output', default='checkpoint.pkl')
+    args = parser.parse_args()
+
+    env = simpy.Environment()
+    components = build_mission(env, args.mode)
+    env.run(until=args.at)
+    save(snapshot(env, components), args.output)
+    st = time.time()
+    env.run(until=args.until)
+    print('Continued in %.3f secs' % (time.time() - st))
+
+    st = time.time()
+    resumed_env, resumed = restore(load(args.output), lambda e: build_mission(e, args.mode))
+    resumed_env.run(until=args.until)
+    print('Resumed in %.3f secs' % (time.time() - st))
+    for name, auv in (('continued', components['auv']), ('resumed', resumed['auv'])):
+        print('%-10s inspections %d, last at %s, pose %s' % (name, auv.inspections, auv.last_inspection_time,
+                                                              auv.trajectory.pose_at(args.until)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+__author__ = 'nick'
+
+# Euclidean cost matrix that is kept alive between replans. Rows and columns are added when targets appear and
+# masked out when they are classified so the full matrix never has to be rebuilt point by point.
+
+import numpy as np
+
+
+def distance_matrix(points, others=None):
+    """
+    Euclidean distances between all pairs of points computed in one broadcasted operation.
+    :param points: Array of shape (n, d).
+    :param others: Optional array of shape (m, d). If none is provided the points are used.
+    :return: Array of shape (n, m) with the distances.
+    """
+    points = np.asarray(points, dtype=float)
+    if others is None:
+        others = points
+    others = np.asarray(others, dtype=float)
+    diff = points[:, np.newaxis, :] - others[np.newaxis, :, :]
+    return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+
+class CostMatrix:
+    """
+    Incrementally maintained distance matrix between targets. Targets are identified by a key (the target id).
+    """
+
+    def __init__(self, dim=3, capacity=16):
+        self.dim = dim
+        self.size = 0
+        self.keys = []
+        self.index = {}
+        self.pos = np.zeros((capacity, dim))
+        self.dist = np.zeros((capacity, capacity))
+        self.active = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return int(self.active[:self.size].sum())
+
+    def __contains__(self, key):
+        return key in self.index and self.active[self.index[key]]
+
+    def _grow(self):
+        capacity = 2 * self.pos.shape[0]
+        pos = np.zeros((capacity, self.dim))
+        pos[:self.size] = self.pos[:self.size]
+        dist = np.zeros((capacity, capacity))
+        dist[:self.size, :self.size] = self.dist[:self.size, :self.size]
+        active = np.zeros(capacity, dtype=bool)
+        active[:self.size] = self.active[:self.size]
+        self.pos, self.dist, self.active = pos, dist, active
+
+    def add(self, key, pos):
+        """
+        Adds a target. Only the new row and column are computed.
+        :param key: Unique key of the target.
+        :param pos: Position of the target.
+        """
+        if key in self.index:
+            # Target reappeared, just unmask it
+            self.active[self.index[key]] = True
+            return
+        if self.size == self.pos.shape[0]:
+            self._grow()
+        i = self.size
+        self.pos[i] = pos
+        d = distance_matrix(self.pos[i:i + 1], self.pos[:i + 1])[0]
+        self.dist[i, :i + 1] = d
+        self.dist[:i + 1, i] = d
+        self.active[i] = True
+        self.keys.append(key)
+        self.index[key] = i
+        self.size += 1
+
+    def discard(self, key):
+        """
+        Masks a target out of the matrix, for example when it gets classified.
+        :param key: Unique key of the target.
+        """
+        if key in self.index:
+            self.active[self.index[key]] = False
+
+    def positions(self, keys):
+        return self.pos[[self.index[k] for k in keys]]
+
+    def _origin_costs(self, origin, idx):
+        return distance_matrix(np.asarray(origin, dtype=float).reshape(1, -1), self.pos[idx])[0]
+
+    def route_legs(self, keys, origin=None):
+        """
+        Costs of the consecutive legs of a route through the targets.
+        :param keys: Keys of the targets in route order.
+        :param origin: Optional position the route starts from.
+        :return: Array with the cost of every leg.
+        """
+        idx = [self.index[k] for k in keys]
+        legs = self.dist[idx[:-1], idx[1:]]
+        if origin is not None and len(idx) > 0:
+            legs = np.concatenate((self._origin_costs(origin, idx[:1]), legs))
+        return legs
+
+    def costs_to(self, key, keys, origin=None):
+        """
+        Costs from a list of targets to one target, without building the cost matrix.
+        :param key: Key of the target.
+        :param keys: Keys of the other targets.
+        :param origin: Optional position that is prepended to the other targets.
+        :return: Array with one cost per other target.
+        """
+        i = self.index[key]
+        costs = self.dist[[self.index[k] for k in keys], i]
+        if origin is not None:
+            costs = np.concatenate((self._origin_costs(origin, [i]), costs))
+        return costs
+
+    def active_keys(self):
+        return [self.keys[i] for i in np.flatnonzero(self.active[:self.size])]
+
+    def matrix(self, origin=None, keys=None):
+        """
+        Cost matrix of the active targets.
+        :param origin: Optional position (e.g. the vehicle) that is prepended as the first point of the matrix.
+        :param keys: Optional keys of the targets of the matrix, for callers that keep track of them. If none are
+        provided the active targets are used.
+        :return: The keys of the targets in matrix order and the cost matrix.
+        """
+        if keys is None:
+            idx = np.flatnonzero(self.active[:self.size])
+            keys = [self.keys[i] for i in idx]
+        else:
+            idx = [self.index[k] for k in keys]
+        if origin is None:
+            return keys, self.dist[np.ix_(idx, idx)]
+        n = len(idx) + 1
+        cost = np.zeros((n, n))
+        cost[1:, 1:] = self.dist[np.ix_(idx, idx)]
+        d = self._origin_costs(origin, idx)
+        cost[0, 1:] = d
+        cost[1:, 0] = d
+        return keys, cost
@@ -0,0 +1,240 @@
+__author__ = 'nick'
+
+# Fleet level executor. The state of all vehicles is kept in NumPy arrays indexed by vehicle so that thousands of
+# vehicles fit in one process and bulk queries such as the positions of all vehicles are a single vectorized call.
+# It speaks the same pipe protocol as AuvExecutor (plan requests, plan feedback, navigation requests and updates) with
+# one pipe per vehicle, so it can take the place of a list of AuvExecutor with FleetPlanner.
+
+import argparse
+import math
+import time
+from functools import partial
+import numpy as np
+import simpy
+
+from msgs import *
+
+
+class FleetExecutor:
+    """
+    Executes the plans of a fleet of vehicles. Each vehicle goes through the same states as AuvExecutor (idle,
+    navigate to target, inspect target) but instead of a generator per vehicle its actions are scheduled as plain
+    timeout events with a callback. Plans are full PlanReqMsg, target ids are global to the fleet as with FleetPlanner.
+    """
+    # States
+    idle = 0
+    navigate_to_target = 1
+    inspect_target = 2
+
+    # Actions
+    no_action = 0
+    rotate = 1
+    move = 2
+    inspect = 3
+
+    # Vehicle constants
+    linear_vel = 0.8  # In meters per second
+    rot_vel = 0.3  # In rad per second
+    inspection_duration = 120  # Inspection duration in seconds.
+
+    def __init__(self, env, n, positions=None, plan_requests=None, plan_feedbacks=None, nav_reqs=None,
+                 nav_updates=None):
+        """
+        :param env: SimPy environment.
+        :param n: Number of vehicles.
+        :param positions: Optional initial NED positions, array of shape (n, 3).
+        :param plan_requests: Optional list of plan request pipes, one per vehicle.
+        :param plan_feedbacks: Optional list of plan feedback pipes, one per vehicle.
+        :param nav_reqs: Optional list of navigation request pipes, one per vehicle.
+        :param nav_updates: Optional list of navigation update pipes, one per vehicle, answers to the requests.
+        """
+        self.env = env
+        self.n = n
+        self.pos = np.zeros((n, 3)) if positions is None else np.array(positions, dtype=float)
+        self.goal = self.pos.copy()
+        self.yaw = np.zeros(n)
+        self.goal_yaw = np.zeros(n)
+        self.curr_lin_vel = np.zeros(n)
+        self.curr_rot_vel = np.zeros(n)
+        self.action_start = np.zeros(n)
+        self.action_end = np.zeros(n)
+        self.state = np.zeros(n, dtype=np.int8)
+        self.action = np.zeros(n, dtype=np.int8)
+        self.cursor = np.zeros(n, dtype=int)
+        self.epoch = np.zeros(n, dtype=int)  # Invalidates the scheduled events of a vehicle when it is replanned
+        self.plan_pos = [np.zeros((0, 3)) for i in range(n)]
+        self.plan_ids = [[] for i in range(n)]
+        self.pending_plans = {}
+        self.classified = set()
+        self.plan_requests = plan_requests
+        self.plan_feedbacks = plan_feedbacks
+        self.nav_reqs = nav_reqs
+        self.nav_updates = nav_updates
+        if plan_requests is not None:
+            for i in range(n):
+                self.plan_requests[i].subscribe(partial(self.handle_plan_msg, i))
+        if nav_reqs is not None:
+            for i in range(n):
+                self.nav_reqs[i].subscribe(partial(self.handle_nav_req, i))
+
+    def positions(self, t=None, vehicles=None):
+        """
+        Positions of the vehicles.
+        :param t: Time of the query, it has to be within the current actions. Defaults to now.
+        :param vehicles: Optional index or indices of the vehicles. Defaults to all vehicles.
+        :return: Array of shape (n, 3).
+        """
+        vehicles = self._vehicles(vehicles)
+        frac = self._progress(t, vehicles)
+        moving = self.action[vehicles] == self.move
+        pos = self.pos[vehicles].copy()
+        goal = self.goal[vehicles]
+        pos[moving] += frac[moving, np.newaxis] * (goal[moving] - pos[moving])
+        return pos
+
+    def yaws(self, t=None, vehicles=None):
+        """
+        Yaw of the vehicles.
+        :param t: Time of the query, it has to be within the current actions. Defaults to now.
+        :param vehicles: Optional index or indices of the vehicles. Defaults to all vehicles.
+        :return: Array of length n.
+        """
+        vehicles = self._vehicles(vehicles)
+        frac = self._progress(t, vehicles)
+        rotating = self.action[vehicles] == self.rotate
+        yaw = self.yaw[vehicles].copy()
+        goal_yaw = self.goal_yaw[vehicles]
+        yaw[rotating] += frac[rotating] * (goal_yaw[rotating] - yaw[rotating])
+        return yaw
+
+    def _vehicles(self, vehicles):
+        if vehicles is None:
+            return slice(None)
+        return np.atleast_1d(vehicles)
+
+    def _progress(self, t, vehicles):
+        if t is None:
+            t = self.env.now
+        start = self.action_start[vehicles]
+        duration = self.action_end[vehicles] - start
+        return np.clip((t - start) / np.where(duration > 0, duration, 1.0), 0.0, 1.0)
+
+    def set_plan(self, i, positions, ids):
+        """
+        Replaces the plan of a vehicle. A vehicle that is navigating stops where it is and heads to the first target
+        of the new plan, an inspection is finished first.
+        :param i: Index of the vehicle.
+        :param positions: NED positions of the targets in the order they are visited.
+        :param ids: Ids of the targets.
+        """
+        positions = np.array(positions, dtype=float).reshape(-1, 3)
+        if self.state[i] == self.inspect_target:
+            self.pending_plans[i] = (positions, list(ids))
+            return
+        if self.state[i] == self.navigate_to_target:
+            self._stop(i)
+        self.plan_pos[i] = positions
+        self.plan_ids[i] = list(ids)
+        self.cursor[i] = 0
+        self._next_target(i)
+
+    def handle_plan_msg(self, i, msg):
+        targets = [msg.target_list[k] for k in msg.target_order]
+        self.set_plan(i, [t.ned_pos for t in targets], [t.id for t in targets])
+
+    def handle_nav_req(self, i, msg):
+        self.nav_updates[i].put(NavUpdateMsg(self.positions(vehicles=i)[0].tolist()))
+
+    def _stop(self, i):
+        # Freezes the vehicle at its current pose and drops its scheduled events
+        self.pos[i] = self.positions(vehicles=i)[0]
+        self.yaw[i] = self.yaws(vehicles=i)[0]
+        self.goal[i] = self.pos[i]
+        self.goal_yaw[i] = self.yaw[i]
+        self.curr_lin_vel[i] = 0
+        self.curr_rot_vel[i] = 0
+        self.action[i] = self.no_action
+        self.action_start[i] = self.action_end[i] = self.env.now
+        self.epoch[i] += 1
+
+    def _schedule(self, i, action, duration):
+        self.action[i] = action
+        self.action_start[i] = self.env.now
+        self.action_end[i] = self.env.now + duration
+        event = self.env.timeout(duration)
+        event.callbacks.append(partial(self._advance, i, self.epoch[i]))
+
+    def _next_target(self, i):
+        # Skips the targets that were classified in the meantime
+        while self.cursor[i] < len(self.plan_ids[i]) and self.plan_ids[i][self.cursor[i]] in self.classified:
+            self.cursor[i] += 1
+        if self.cursor[i] >= len(self.plan_ids[i]):
+            self.state[i] = self.idle
+            self.action[i] = self.no_action
+            return
+        self.state[i] = self.navigate_to_target
+        self.goal[i] = self.plan_pos[i][self.cursor[i]]
+        diff = self.goal[i] - self.pos[i]
+        turn = math.atan2(diff[1], diff[0]) - self.yaw[i]
+        turn = (turn + math.pi) % (2 * math.pi) - math.pi
+        self.goal_yaw[i] = self.yaw[i] + turn
+        self.curr_rot_vel[i] = self.rot_vel
+        self._schedule(i, self.rotate, abs(turn) / self.rot_vel)
+
+    def _advance(self, i, epoch, event):
+        if epoch != self.epoch[i]:
+            # Stale event of a plan that was replaced
+            return
+        action = self.action[i]
+        if action == self.rotate:
+            self.yaw[i] = (self.goal_yaw[i] + math.pi) % (2 * math.pi) - math.pi
+            self.goal_yaw[i] = self.yaw[i]
+            self.curr_rot_vel[i] = 0
+            self.curr_lin_vel[i] = self.linear_vel
+            self._schedule(i, self.move, np.linalg.norm(self.goal[i] - self.pos[i]) / self.linear_vel)
+        elif action == self.move:
+            self.pos[i] = self.goal[i]
+            self.curr_lin_vel[i] = 0
+            self.state[i] = self.inspect_target
+            self._schedule(i, self.inspect, self.inspection_duration)
+        elif action == self.inspect:
+            target_id = self.plan_ids[i][self.cursor[i]]
+            self.classified.add(target_id)
+            if self.plan_feedbacks is not None:
+                self.plan_feedbacks[i].put(PlanFeedbackMsg(target_id, "Mine"))
+            self.cursor[i] += 1
+            self.state[i] = self.idle
+            self.action[i] = self.no_action
+            if i in self.pending_plans:
+                positions, ids = self.pending_plans.pop(i)
+                self.set_plan(i, positions, ids)
+            else:
+                self._next_target(i)
+
+
+def main():
+    from pipe import Pipe
+    from sim_auv_planner import FleetPlanner
+    from bench_sim import random_targets
+
+    parser = argparse.ArgumentParser(description='Fleet mission with FleetPlanner and FleetExecutor.')
+    parser.add_argument('--vehicles', type=int, default=100)
+    parser.add_argument('--targets', type=int, default=10, help='Targets per vehicle.')
+    parser.add_argument('--until', type=float, default=12 * 3600)
+    args = parser.parse_args()
+
+    env = simpy.Environment()
+    pipes = [[Pipe(env, 0) for i in range(args.vehicles)] for k in range(4)]
+    # The area grows with the fleet so that every vehicle gets an area of the same size
+    targets = random_targets(args.vehicles * args.targets, extent=500.0 * math.sqrt(args.vehicles))
+    planner = FleetPlanner(env, *pipes, targets=targets, engine='heuristic', workers=0)
+    fleet = FleetExecutor(env, args.vehicles, None, *pipes)
+    st = time.time()
+    env.run(until=args.until)
+    print('%d vehicles, %d of %d targets classified in %.3f secs' % (
+        args.vehicles, len(fleet.classified), len(targets), time.time() - st))
+    planner.close()
+
+
+if __name__ == '__main__':
+    main()
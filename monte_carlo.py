@@ -0,0 +1,152 @@
+__author__ = 'nick'
+
+# Monte Carlo runner for the sim_auv (target generator) and sim_auv_planner (planner) missions. Seeded scenarios are
+# executed in worker processes, one simpy.Environment per task, and the per run metrics are streamed into a table.
+
+import argparse
+import contextlib
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import simpy
+
+from pipe import Pipe
+from trajectory import TRANSLATE
+
+METRICS = ('completed', 'completion_time', 'distance', 'replans', 'inspections', 'wall_time')
+
+
+def make_scenario(seed, mode='planner', n_targets=(4, 20), extent=500.0, linear_vel=(0.5, 1.5), rot_vel=(0.1, 0.5),
+                  inspection_duration=(60, 180), duration=6 * 3600):
+    """
+    Draws a random scenario. Ranges are given as (low, high) tuples.
+    :param seed: Seed of the scenario, the same seed always gives the same scenario.
+    :param mode: 'planner' for AuvPlanner missions or 'generator' for TargetGenerator missions.
+    :return: A dictionary describing the scenario.
+    """
+    rng = np.random.RandomState(seed)
+    n = rng.randint(n_targets[0], n_targets[1] + 1)
+    targets = rng.uniform(-extent, extent, (n, 3))
+    targets[:, 2] = rng.uniform(0, extent / 10, n)
+    return {'seed': seed,
+            'mode': mode,
+            'targets': targets.tolist(),
+            'linear_vel': rng.uniform(*linear_vel),
+            'rot_vel': rng.uniform(*rot_vel),
+            'inspection_duration': rng.uniform(*inspection_duration),
+            'duration': duration}
+
+
+def run_scenario(scenario):
+    """
+    Runs one scenario in a fresh simpy.Environment.
+    :return: A dictionary with the scenario parameters and the mission metrics.
+    """
+    # Imported here so that the workers import the simulation modules themselves
+    from sim_auv import AuvExecutor, TargetGenerator
+    from sim_auv_planner import AuvPlanner
+
+    st = time.time()
+    env = simpy.Environment()
+    plan_request = Pipe(env, 0)
+    plan_feedback = Pipe(env, 0)
+    nav_req = Pipe(env, 0)
+    nav_update = Pipe(env, 0)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        auv = AuvExecutor(env, "auv", plan_request, plan_feedback, nav_req, nav_update)
+        auv.linear_vel = scenario['linear_vel']
+        auv.rot_vel = scenario['rot_vel']
+        auv.inspection_duration = scenario['inspection_duration']
+        if scenario['mode'] == 'planner':
+            AuvPlanner(env, plan_request, plan_feedback, nav_req, nav_update, engine='heuristic',
+                       targets=scenario['targets'])
+        else:
+            TargetGenerator(env, plan_request, plan_feedback, nav_req, nav_update, targets=scenario['targets'])
+        env.run(until=scenario['duration'])
+
+    segments = auv.trajectory.segments()
+    distance = float(sum(np.linalg.norm(s.pose1[:3] - s.pose0[:3]) for s in segments if s.kind == TRANSLATE))
+    completed = auv.inspections >= len(scenario['targets'])
+    return {'seed': scenario['seed'],
+            'mode': scenario['mode'],
+            'n_targets': len(scenario['targets']),
+            'linear_vel': scenario['linear_vel'],
+            'rot_vel': scenario['rot_vel'],
+            'inspection_duration': scenario['inspection_duration'],
+            'completed': completed,
+            'completion_time': auv.last_inspection_time if completed else float('nan'),
+            'distance': distance,
+            'replans': auv.plans_received,
+            'inspections': auv.inspections,
+            'wall_time': time.time() - st}
+
+
+def run_batch(n_runs, seed=0, workers=None, output=None, **kwargs):
+    """
+    Runs n_runs scenarios with seeds seed, seed + 1, ... in a process pool.
+    :param workers: Number of worker processes, defaults to the number of cores.
+    :param output: Optional CSV file the rows are streamed to as the runs finish.
+    :param kwargs: Passed to make_scenario.
+    :return: The rows of all runs sorted by seed.
+    """
+    scenarios = [make_scenario(seed + k, **kwargs) for k in range(n_runs)]
+    rows = []
+    writer = None
+    f = open(output, 'w') if output is not None else None
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(run_scenario, s) for s in scenarios]
+            for future in as_completed(futures):
+                row = future.result()
+                rows.append(row)
+                if f is not None:
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                        writer.writeheader()
+                    writer.writerow(row)
+                    f.flush()
+    finally:
+        if f is not None:
+            f.close()
+    rows.sort(key=lambda r: r['seed'])
+    return rows
+
+
+def summarize(rows):
+    """
+    Aggregated statistics of the metrics over the runs.
+    :return: A dictionary from metric to (mean, std, min, max), NaN values are ignored.
+    """
+    summary = {}
+    for metric in METRICS:
+        values = np.array([r[metric] for r in rows], dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            summary[metric] = (float('nan'),) * 4
+        else:
+            summary[metric] = (values.mean(), values.std(), values.min(), values.max())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo runs of the AUV missions.')
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mode', choices=['planner', 'generator'], default='planner')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='monte_carlo.csv')
+    args = parser.parse_args()
+
+    st = time.time()
+    rows = run_batch(args.runs, args.seed, args.workers, args.output, mode=args.mode)
+    print('%d runs in %.2f secs' % (len(rows), time.time() - st))
+    print('%-16s %12s %12s %12s %12s' % ('metric', 'mean', 'std', 'min', 'max'))
+    for metric, (mean, std, lo, hi) in summarize(rows).items():
+        print('%-16s %12.2f %12.2f %12.2f %12.2f' % (metric, mean, std, lo, hi))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+__author__ = 'nick'
+
+# Topic based publish/subscribe bus. Topics are created on first use by name, e.g. "auv3/nav_update", so a fleet
+# needs one set of topics per vehicle instead of hand wired pipes, and a monitor can subscribe to a pattern such as
+# "*/nav_update" to see every vehicle. A topic is a Pipe with its own subscriber fan-out and can be passed to the
+# simulation components in place of a pipe.
+#
+# Every subscriber has its own queue, optionally bounded. When a bounded queue is full a new message either
+# overwrites the oldest one, which suits telemetry such as NavUpdateMsg where only the latest value matters, or is
+# dropped. Subscribers with a handler have their queue flushed to the handler by one event per topic and time step,
+# subscribers without one pull messages with get() or drain().
+
+import argparse
+from collections import deque
+from fnmatch import fnmatchcase
+from functools import partial
+import time
+import simpy
+
+from pipe import Pipe, wrap_handler
+
+# Policies of a full queue
+OVERWRITE_OLDEST = 'overwrite'
+DROP_NEWEST = 'drop'
+
+
+class Subscription:
+    """
+    Queue of the messages of a topic for one subscriber.
+    """
+
+    def __init__(self, topic, handler=None, batch=False, depth=None, policy=OVERWRITE_OLDEST):
+        """
+        :param topic: Topic of the subscription.
+        :param handler: Function called with each message, None for a pull subscription.
+        :param batch: Call the handler once with the list of the queued messages instead.
+        :param depth: Maximum number of queued messages, None for unbounded.
+        :param policy: OVERWRITE_OLDEST or DROP_NEWEST, what to do with a message when the queue is full.
+        """
+        if policy not in (OVERWRITE_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown queue policy {0}".format(policy))
+        self.topic = topic
+        self.handler = handler
+        self.call = wrap_handler(topic.env, handler) if handler is not None else None
+        self.batch = batch
+        self.depth = depth
+        self.policy = policy
+        self.queue = deque()
+        self.getters = deque()  # Get events of a pull subscription waiting for a message
+        self.received = 0
+        self.dropped = 0
+
+    def offer(self, value):
+        self.received += 1
+        if self.getters:
+            self.getters.popleft().succeed(value)
+            return
+        if self.depth is not None and len(self.queue) >= self.depth:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            self.queue.popleft()
+        self.queue.append(value)
+
+    def drain(self):
+        """
+        :return: The queued messages, oldest first. The queue is empty afterwards.
+        """
+        values = list(self.queue)
+        self.queue.clear()
+        return values
+
+    def flush(self):
+        if not self.queue:
+            return
+        if self.batch:
+            self.call(self.drain())
+        else:
+            while self.queue:
+                self.call(self.queue.popleft())
+
+    def get(self):
+        """
+        :return: An event that succeeds with the next message of a pull subscription.
+        """
+        event = self.topic.env.event()
+        if self.queue:
+            event.succeed(self.queue.popleft())
+        else:
+            self.getters.append(event)
+        return event
+
+
+class Topic(Pipe):
+    """
+    Named channel of a MessageBus. Delivery is the one of Pipe, with the messages of the same time step sharing one
+    timeout, only the hand over to the subscribers differs: every subscription gets every message. get() reads from a
+    shared unbounded pull subscription, created by the first get, so as with a pipe each message is taken by one get.
+    """
+
+    def __init__(self, env, name, delay=0):
+        Pipe.__init__(self, env, delay, batch=True)
+        self.name = name
+        self.subscriptions = []
+        self.default = None  # Pull subscription of get()
+
+    def arrive(self, value):
+        push = False
+        for subscription in self.subscriptions:
+            subscription.offer(value)
+            push = push or subscription.handler is not None
+        if push:
+            self.arrived.append(value)
+            self._schedule_flush()
+
+    def flush(self, event):
+        self.flush_event = None
+        self.arrived = []
+        for subscription in list(self.subscriptions):
+            if subscription.handler is not None:
+                subscription.flush()
+
+    def subscribe(self, handler=None, batch=False, depth=None, policy=OVERWRITE_OLDEST):
+        """
+        Adds a subscriber, see Subscription.
+        :return: The subscription.
+        """
+        subscription = Subscription(self, handler, batch, depth, policy)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, handler):
+        """
+        :param handler: Handler or subscription to remove.
+        """
+        self.subscriptions = [s for s in self.subscriptions if s is not handler and s.handler != handler]
+
+    def get(self):
+        if self.default is None:
+            self.default = self.subscribe()
+        return self.default.get()
+
+    def get_state(self):
+        """
+        :return: The messages in flight, as in Pipe.get_state, and the queues of the subscriptions in subscription
+        order. The messages delivered at this time step are in the queues already.
+        """
+        return {'in_flight': self._in_flight_messages(),
+                'queues': [list(s.queue) for s in self.subscriptions if s is not self.default],
+                'default': list(self.default.queue) if self.default is not None else None}
+
+    def set_state(self, state):
+        """
+        Restores a state of get_state. The subscribers have to subscribe in the same order as in the simulation the
+        state was taken from.
+        """
+        subscriptions = [s for s in self.subscriptions if s is not self.default]
+        if len(subscriptions) != len(state['queues']):
+            raise ValueError("Topic {0} has {1} subscriptions, the state has {2}".format(
+                self.name, len(subscriptions), len(state['queues'])))
+        for subscription, queue in zip(subscriptions, state['queues']):
+            subscription.queue.extend(queue)
+        if state['default'] is not None:
+            if self.default is None:
+                self.default = self.subscribe()
+            self.default.queue.extend(state['default'])
+        Pipe.set_state(self, state['in_flight'])
+        if any(s.handler is not None and s.queue for s in subscriptions):
+            self._schedule_flush()
+
+
+class MessageBus:
+    """
+    Set of topics by name. Pattern subscriptions also apply to the topics created later.
+    """
+
+    def __init__(self, env, delay=0):
+        """
+        :param env: SimPy environment.
+        :param delay: Default delay of the topics.
+        """
+        self.env = env
+        self.delay = delay
+        self.topics = {}
+        self.patterns = []  # (pattern, handler, subscribe keyword arguments)
+
+    def __contains__(self, name):
+        return name in self.topics
+
+    def topic(self, name, delay=None):
+        """
+        :return: The topic with the name, created if it does not exist.
+        """
+        topic = self.topics.get(name)
+        if topic is None:
+            topic = Topic(self.env, name, self.delay if delay is None else delay)
+            self.topics[name] = topic
+            for pattern, handler, kwargs in self.patterns:
+                if fnmatchcase(name, pattern):
+                    topic.subscribe(partial(handler, name), **kwargs)
+        return topic
+
+    def publish(self, name, value):
+        self.topic(name).put(value)
+
+    def subscribe(self, pattern, handler, **kwargs):
+        """
+        Subscribes a handler to every topic matching a shell style pattern, now and in the future.
+        :param pattern: Topic name or pattern, e.g. "*/nav_update".
+        :param handler: Function called with the topic name and the message (or the list of messages with batch).
+        :param kwargs: Options of Topic.subscribe.
+        """
+        self.patterns.append((pattern, handler, kwargs))
+        for name, topic in self.topics.items():
+            if fnmatchcase(name, pattern):
+                topic.subscribe(partial(handler, name), **kwargs)
+
+    def vehicle_topics(self, vehicle):
+        """
+        :return: The plan_request, plan_feedback, nav_req and nav_update topics of a vehicle, in the order
+        AuvExecutor and AuvPlanner take their pipes.
+        """
+        return [self.topic("{0}/{1}".format(vehicle, name))
+                for name in ('plan_request', 'plan_feedback', 'nav_req', 'nav_update')]
+
+
+class Monitor:
+    """
+    Keeps the latest navigation update and counts the plan feedback of every vehicle on a bus.
+    """
+
+    def __init__(self, bus):
+        self.positions = {}
+        self.classified = 0
+        bus.subscribe("*/nav_update", self.handle_nav_update, depth=1, policy=OVERWRITE_OLDEST)
+        bus.subscribe("*/plan_feedback", self.handle_plan_feedback)
+
+    def handle_nav_update(self, topic, msg):
+        self.positions[topic.split('/')[0]] = msg.pos
+
+    def handle_plan_feedback(self, topic, msg):
+        self.classified += 1
+
+
+def main():
+    from sim_auv import AuvExecutor
+    from sim_auv_planner import AuvPlanner
+    from bench_sim import random_targets
+
+    parser = argparse.ArgumentParser(description='Fleet of single vehicle missions wired through a message bus.')
+    parser.add_argument('--vehicles', type=int, default=100)
+    parser.add_argument('--targets', type=int, default=10)
+    parser.add_argument('--until', type=float, default=6 * 3600)
+    args = parser.parse_args()
+
+    env = simpy.Environment()
+    bus = MessageBus(env)
+    monitor = Monitor(bus)
+    for i in range(args.vehicles):
+        name = "auv%d" % i
+        topics = bus.vehicle_topics(name)
+        AuvExecutor(env, name, *topics)
+        AuvPlanner(env, *topics, engine='heuristic', targets=random_targets(args.targets, seed=i))
+    st = time.time()
+    env.run(until=args.until)
+    print('%d vehicles, %d topics, %d targets classified in %.3f secs' % (
+        args.vehicles, len(bus.topics), monitor.classified, time.time() - st))
+
+
+if __name__ == '__main__':
+    main()
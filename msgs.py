@@ -1,26 +1,44 @@
 __author__ = 'nick'
 
-# Message definitions for process communication
+# Message definitions for process communication. Messages use __slots__, they are created for every exchange and
+# have no per instance dictionary.
+
+# Operations of a PlanDeltaMsg
+PLAN_INSERT = 0  # (PLAN_INSERT, target, after_id), insert after the target after_id or first if after_id is None
+PLAN_REMOVE = 1  # (PLAN_REMOVE, target_id)
+PLAN_REORDER = 2  # (PLAN_REORDER, target_ids), new order of the remaining targets of the plan
 
 
 class PlanReqMsg:
     """
     Class that represents a plan request from the planner to the executor.
     """
-    target_list = []
-    target_order = []
+    __slots__ = ('target_list', 'target_order', 'version')
 
-    def __init__(self, targets, order):
+    def __init__(self, targets, order, version=0):
         self.target_list = targets
         self.target_order = order
+        self.version = version
+
+
+class PlanDeltaMsg:
+    """
+    Change of the plan of version base_version that gives the plan of version version. The operations refer to the
+    targets by id so they do not depend on how far the executor got in the plan.
+    """
+    __slots__ = ('base_version', 'version', 'ops')
+
+    def __init__(self, base_version, version, ops):
+        self.base_version = base_version
+        self.version = version
+        self.ops = ops
 
 
 class PlanFeedbackMsg:
     """
     Class that represents a plan feedback for each plan action.
     """
-    target_id = 0
-    target_class = ""
+    __slots__ = ('target_id', 'target_class')
 
     def __init__(self, id, classificaton):
         self.target_id = id
@@ -31,17 +49,15 @@ class NavReqMsg:
     """
     Dummy request message
     """
+    __slots__ = ()
     req = True
 
-    def __init__(self):
-        pass
-
 
 class NavUpdateMsg:
     """
     Navigation position update message
     """
-    pos = [0, 0, 0]
+    __slots__ = ('pos',)
 
     def __init__(self, pos):
         self.pos = pos
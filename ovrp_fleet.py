@@ -0,0 +1,109 @@
+__author__ = 'nick'
+
+# Multi vehicle open vehicle routing. Targets are first clustered among the vehicles and then the single vehicle OVRP
+# of each cluster is solved independently, optionally in a pool of worker processes.
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cost_matrix import distance_matrix
+from ovrp_solver import solve_ovrp
+
+
+def partition_targets(targets, starts, iterations=20):
+    """
+    Partitions the targets among the vehicles with k-means seeded at the vehicle positions, so cluster i belongs to
+    vehicle i.
+    :param targets: Array of shape (n, d) with the target positions.
+    :param starts: Array of shape (k, d) with the vehicle positions.
+    :param iterations: Maximum number of k-means iterations.
+    :return: Array of length n with the index of the vehicle each target is assigned to.
+    """
+    targets = np.asarray(targets, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    if len(targets) == 0:
+        return np.zeros(0, dtype=int)
+    centres = starts.copy()
+    labels = np.argmin(distance_matrix(targets, centres), axis=1)
+    for _ in range(iterations):
+        for i in range(len(centres)):
+            members = targets[labels == i]
+            # A vehicle without targets stays anchored at its own position
+            centres[i] = members.mean(axis=0) if len(members) > 0 else starts[i]
+        new_labels = np.argmin(distance_matrix(targets, centres), axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return labels
+
+
+def solve_partition(start, targets, engine='auto'):
+    """
+    Solves the OVRP of a single vehicle starting at start and visiting all targets. The end of the route is left
+    free by routing to a dummy point that can be reached from every target at no cost.
+    :param start: Position of the vehicle.
+    :param targets: Array of shape (n, d) with the target positions.
+    :param engine: OVRP engine, see ovrp_solver.ENGINES.
+    :return: The order in which the targets are visited as indices into targets.
+    """
+    n = len(targets)
+    if n < 2:
+        return list(range(n))
+    points = np.vstack((np.asarray(start, dtype=float), np.asarray(targets, dtype=float)))
+    cost = np.zeros((n + 2, n + 2))
+    cost[:n + 1, :n + 1] = distance_matrix(points)
+    route, total_cost, model = solve_ovrp(cost, 0, n + 1, engine=engine)
+    return [int(i) - 1 for i in route[1:-1]]
+
+
+def _solve_partition(args):
+    # Top level so that it can be sent to the worker processes
+    return solve_partition(*args)
+
+
+def solve_fleet(targets, starts, engine='auto', pool=None):
+    """
+    Clusters the targets among the vehicles and solves the OVRP of every cluster.
+    :param targets: Array of shape (n, d) with the target positions.
+    :param starts: Array of shape (k, d) with the vehicle positions.
+    :param engine: OVRP engine, see ovrp_solver.ENGINES.
+    :param pool: Optional concurrent.futures executor. If none is provided the clusters are solved sequentially.
+    :return: A list with the visiting order of each vehicle as indices into targets.
+    """
+    targets = np.asarray(targets, dtype=float)
+    labels = partition_targets(targets, starts)
+    members = [np.flatnonzero(labels == i) for i in range(len(starts))]
+    jobs = [(starts[i], targets[members[i]], engine) for i in range(len(starts))]
+    if pool is None:
+        orders = [_solve_partition(job) for job in jobs]
+    else:
+        orders = list(pool.map(_solve_partition, jobs))
+    return [[int(members[i][k]) for k in orders[i]] for i in range(len(starts))]
+
+
+def main():
+    import time
+
+    np.random.seed(47)
+    n = 300
+    k = 6
+    targets = np.random.uniform(-1000, 1000, (n, 3))
+    targets[:, 2] = np.random.uniform(0, 50, n)
+    starts = np.zeros((k, 3))
+    starts[:, 0] = np.linspace(-1000, 1000, k)
+
+    st = time.time()
+    orders = solve_fleet(targets, starts, engine='heuristic')
+    print('Sequential: %.2f secs' % (time.time() - st))
+
+    pool = ProcessPoolExecutor()
+    st = time.time()
+    orders = solve_fleet(targets, starts, engine='heuristic', pool=pool)
+    print('Process pool: %.2f secs' % (time.time() - st))
+    pool.shutdown()
+
+    for i in range(k):
+        print('Vehicle %d: %d targets' % (i, len(orders[i])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+__author__ = 'nick'
+
+# Heuristic Open Vehicle Routing Problem solver. Builds a route with a nearest neighbour pass and improves it with
+# 2-opt and Or-opt moves. Only depends on NumPy so it can be used on nodes without a Gurobi licence.
+
+import time
+import numpy as np
+
+EPS = 1e-9
+
+
+def route_cost(cost, route):
+    """
+    Total cost of travelling along a route.
+    :param cost: Cost matrix for traveling from point to point.
+    :param route: Sequence of point indices.
+    :return: The sum of the costs of the consecutive legs of the route.
+    """
+    route = np.asarray(route, dtype=int)
+    if len(route) < 2:
+        return 0.0
+    return float(cost[route[:-1], route[1:]].sum())
+
+
+def nearest_neighbour(cost, start, finish):
+    """
+    Constructive pass. Starting from the start point always go to the closest unvisited point, the finish point is
+    appended at the end.
+    :param cost: Cost matrix for traveling from point to point.
+    :param start: Index of the starting point.
+    :param finish: Index of the ending point.
+    :return: The route as an array of point indices.
+    """
+    n = cost.shape[0]
+    unvisited = np.ones(n, dtype=bool)
+    unvisited[start] = False
+    unvisited[finish] = False
+    route = [start]
+    curr = start
+    for _ in range(int(unvisited.sum())):
+        dist = np.where(unvisited, cost[curr, :], np.inf)
+        curr = int(np.argmin(dist))
+        unvisited[curr] = False
+        route.append(curr)
+    if finish != start:
+        route.append(finish)
+    return np.array(route, dtype=int)
+
+
+def cheapest_insertion(legs, to_node, from_node, open_end=False):
+    """
+    Cheapest position to insert a point in a route from only the costs of the route legs and the costs to and from
+    the point, so that the full cost matrix is not needed.
+    :param legs: Costs of the legs of the route, legs[i] is the cost from point i to point i + 1 of the route.
+    :param to_node: Costs from every point of the route to the new point.
+    :param from_node: Costs from the new point to every point of the route.
+    :param open_end: Whether the point can be appended after the last point.
+    :return: The position in the route the new point follows and the cost increase.
+    """
+    delta = to_node[:-1] + from_node[1:] - legs
+    if open_end:
+        delta = np.append(delta, to_node[-1])
+    k = int(np.argmin(delta))
+    return k, float(delta[k])
+
+
+def insert_cheapest(cost, route, node, open_end=False):
+    """
+    Inserts a point in the route at the position that increases the route cost the least. The first and last points
+    are kept fixed unless open_end is set, in which case the point can also be appended at the end.
+    :param cost: Cost matrix for traveling from point to point.
+    :param route: Route as an array of point indices.
+    :param node: Index of the point to insert.
+    :param open_end: Whether the point can be appended after the last point.
+    :return: The new route and the cost increase.
+    """
+    route = np.asarray(route, dtype=int)
+    if len(route) < 2:
+        delta = cost[route[-1], node] if len(route) > 0 else 0.0
+        return np.append(route, node), float(delta)
+    k, delta = cheapest_insertion(cost[route[:-1], route[1:]], cost[route, node], cost[node, route], open_end)
+    return np.insert(route, k + 1, node), delta
+
+
+def _reversal_costs(cost, route):
+    # Cumulative difference between travelling each leg of the route backwards and forwards
+    fwd = cost[route[:-1], route[1:]]
+    bwd = cost[route[1:], route[:-1]]
+    return np.concatenate(([0.0], np.cumsum(bwd - fwd)))
+
+
+def _expired(deadline):
+    return deadline is not None and time.time() > deadline
+
+
+def two_opt(cost, route, deadline=None):
+    """
+    Improves the route by reversing segments while the cost decreases. The first and last points are kept fixed.
+    Reversal of a segment also accounts for asymmetric costs inside the segment.
+    :param cost: Cost matrix for traveling from point to point.
+    :param route: Initial route as an array of point indices.
+    :param deadline: Optional wall clock time after which the search stops.
+    :return: The improved route and whether any improvement was made.
+    """
+    route = np.array(route, dtype=int)
+    n = len(route)
+    improved = False
+    if n < 4:
+        return route, improved
+    found = True
+    while found and not _expired(deadline):
+        found = False
+        rev = _reversal_costs(cost, route)
+        for i in range(1, n - 2):
+            a, b = route[i - 1], route[i]
+            js = np.arange(i + 1, n - 1)
+            c, d = route[js], route[js + 1]
+            delta = cost[a, c] + cost[b, d] - cost[a, b] - cost[c, d] + rev[js] - rev[i]
+            k = int(np.argmin(delta))
+            if delta[k] < -EPS:
+                j = js[k]
+                route[i:j + 1] = route[i:j + 1][::-1]
+                rev = _reversal_costs(cost, route)
+                found = True
+                improved = True
+    return route, improved
+
+
+def or_opt(cost, route, max_segment=3, deadline=None):
+    """
+    Improves the route by relocating segments of up to max_segment consecutive points to a cheaper position.
+    The first and last points are kept fixed.
+    :param cost: Cost matrix for traveling from point to point.
+    :param route: Initial route as an array of point indices.
+    :param max_segment: Maximum length of the relocated segments.
+    :param deadline: Optional wall clock time after which the search stops.
+    :return: The improved route and whether any improvement was made.
+    """
+    route = np.array(route, dtype=int)
+    n = len(route)
+    improved = False
+    found = True
+    while found and not _expired(deadline):
+        found = False
+        for length in range(1, max_segment + 1):
+            for i in range(1, n - length):
+                seg = route[i:i + length]
+                prev, nxt = route[i - 1], route[i + length]
+                gain = cost[prev, seg[0]] + cost[seg[-1], nxt] - cost[prev, nxt] - EPS
+                rest = np.concatenate((route[:i], route[i + length:]))
+                u, v = rest[:-1], rest[1:]
+                delta = cost[u, seg[0]] + cost[seg[-1], v] - cost[u, v]
+                # Inserting back at the same place is not a move
+                delta[i - 1] = np.inf
+                k = int(np.argmin(delta))
+                if delta[k] < gain:
+                    route = np.concatenate((rest[:k + 1], seg, rest[k + 1:]))
+                    found = True
+                    improved = True
+    return route, improved
+
+
+def ovrp_heuristic(cost, start=None, finish=None, max_rounds=100, time_limit=None):
+    """
+    Open vehicle routing problem solver for a single vehicle using a nearest neighbour construction followed by
+    2-opt and Or-opt local search. Has the same contract as ovrp_solver. Every improvement keeps a complete route so
+    the search can be stopped at any time and the best route found so far is returned.
+    :param cost: Cost matrix for traveling from point to point.
+    :param start: Optional starting point for the tour. If none is provided the first point of the array is chosen
+    :param finish: Optional ending point of the tour. If none is provided the last point of the array is chosen
+    :param max_rounds: Maximum number of 2-opt/Or-opt rounds.
+    :param time_limit: Optional wall clock budget in seconds for the local search. Bounding max_rounds instead keeps
+    the result independent of the host speed.
+    :return: Returns the route the cost and the model. There is no model for the heuristic so it is None.
+    """
+    cost = np.asarray(cost, dtype=float)
+
+    # Number of points
+    n = cost.shape[0]
+
+    # Check for default values
+    if start is None:
+        start = 0
+    if finish is None:
+        finish = n - 1
+
+    deadline = time.time() + time_limit if time_limit is not None else None
+
+    route = nearest_neighbour(cost, start, finish)
+    for _ in range(max_rounds):
+        route, improved_2opt = two_opt(cost, route, deadline)
+        route, improved_oropt = or_opt(cost, route, deadline=deadline)
+        if not (improved_2opt or improved_oropt) or _expired(deadline):
+            break
+
+    return route, route_cost(cost, route), None
@@ -3,12 +3,21 @@ __author__ = 'nick'
 
 # Simple path optimiser that accepts an entry and exit point in literature it is defined as Open Vehicle Routing Problem
 
+import time
 import numpy as np
-from gurobipy import *
-
-HAS_GUROBI = True
+from ovrp_heuristic import ovrp_heuristic, insert_cheapest
+from cost_matrix import distance_matrix
+
+try:
+    from gurobipy import *
+    HAS_GUROBI = True
+except ImportError:
+    HAS_GUROBI = False
 DEBUG = False
 
+# Available engines. 'auto' picks the MILP when Gurobi is available and the heuristic otherwise.
+ENGINES = ('milp', 'lazy', 'warm', 'heuristic')
+
 # Euclidean distance between two points
 
 
@@ -16,13 +25,14 @@ def distance(points, i, j):
     return np.linalg.norm(points[i, :] - points[j, :])
 
 
-def ovrp_solver(cost, start=None, finish=None):
+def ovrp_solver(cost, start=None, finish=None, time_limit=None):
 
     """
     Open vehicle routing problem solver for a single vehicle using the Gurobi MILP optimiser.
     :param cost: Cost matrix for traveling from point to point.
     :param start: Optional starting point for the tour. If none is provided the first point of the array is chosen
     :param finish: Optional ending point of the tour. If none is provided the last point of the array is chosen
+    :param time_limit: Optional time budget in seconds, the best solution found within it is returned.
     :return: Returns the route the cost and the model.
     """
 
@@ -35,6 +45,7 @@ def ovrp_solver(cost, start=None, finish=None):
     if finish is None:
         finish = n - 1
 
+    build_start = time.time()
     m = Model()
 
     # Create model variables
@@ -83,8 +94,14 @@ def ovrp_solver(cost, start=None, finish=None):
 
     m._vars = vars
     m._uVars = uVars
+    m._build_time = time.time() - build_start
 
+    if time_limit is not None:
+        m.Params.TimeLimit = time_limit
+
+    solve_start = time.time()
     m.optimize()
+    m._solve_time = time.time() - solve_start
     try:
         solution = m.getAttr('X', vars)
         u = m.getAttr('X', uVars)
@@ -93,23 +110,361 @@ def ovrp_solver(cost, start=None, finish=None):
         if DEBUG:
             mat = np.zeros((n, n))
 
-            for k,v in solution.iteritems():
+            for k, v in solution.items():
                 mat[k[0], k[1]] = v
 
             print(mat)
             print(selected)
             print(u)
 
-        route = np.zeros(n, dtype=np.int)
-
-        for k, v in u.iteritems():
-            route[v] = int(k)
+        # The MTZ variables increase along the route, they are not necessarily 0 to n - 1
+        route = np.array(sorted(u, key=lambda k: u[k]), dtype=int)
 
         return route, m.objVal, m
     except GurobiError:
         return 0, 0, 0
 
 
+def _path_and_subtours(succ, start):
+    # Splits a successor array (-1 for no successor) into the path from the start point and the remaining cycles
+    n = len(succ)
+    visited = np.zeros(n, dtype=bool)
+    path = [start]
+    visited[start] = True
+    while succ[path[-1]] >= 0 and not visited[succ[path[-1]]]:
+        path.append(succ[path[-1]])
+        visited[path[-1]] = True
+    subtours = []
+    for i in range(n):
+        if not visited[i]:
+            tour = [i]
+            visited[i] = True
+            while succ[tour[-1]] >= 0 and not visited[succ[tour[-1]]]:
+                tour.append(succ[tour[-1]])
+                visited[tour[-1]] = True
+            subtours.append(tour)
+    return path, subtours
+
+
+def _successors(solution):
+    selected = solution > 0.5
+    return np.where(selected.any(axis=1), np.argmax(selected, axis=1), -1)
+
+
+def _subtour_callback(model, where):
+    # Cuts every sub-tour of a new incumbent with a lazy constraint
+    if where == GRB.Callback.MIPSOL:
+        n = model._n
+        solution = np.array(model.cbGetSolution(model._xlist)).reshape(n, n)
+        path, subtours = _path_and_subtours(_successors(solution), model._start)
+        for tour in subtours:
+            model.cbLazy(quicksum(model._xlist[i * n + j] for i in tour for j in tour if i != j) <= len(tour) - 1)
+
+
+def ovrp_solver_lazy(cost, start=None, finish=None, time_limit=None):
+    """
+    Open vehicle routing problem solver for a single vehicle using the Gurobi MILP optimiser. Variables and degree
+    constraints are created in bulk with the matrix API (gurobipy 10 or newer) and sub-tours are eliminated lazily
+    in a callback instead of with the MTZ constraints. Build and solve times are stored in the model as _build_time
+    and _solve_time.
+    :param cost: Cost matrix for traveling from point to point.
+    :param start: Optional starting point for the tour. If none is provided the first point of the array is chosen
+    :param finish: Optional ending point of the tour. If none is provided the last point of the array is chosen
+    :param time_limit: Optional time budget in seconds, the best solution found within it is returned.
+    :return: Returns the route the cost and the model.
+    """
+
+    # Number of points
+    n = cost.shape[0]
+
+    # Check for default values
+    if start is None:
+        start = 0
+    if finish is None:
+        finish = n - 1
+
+    build_start = time.time()
+    m = Model()
+
+    ub = np.ones((n, n))
+    np.fill_diagonal(ub, 0)
+    x = m.addMVar((n, n), ub=ub, obj=np.asarray(cost, dtype=float), vtype=GRB.BINARY)
+
+    # None exits the finish point and none enters the starting point, all other points are exited and entered once
+    out_degree = np.ones(n)
+    out_degree[finish] = 0
+    in_degree = np.ones(n)
+    in_degree[start] = 0
+    m.addConstr(x.sum(axis=1) == out_degree)
+    m.addConstr(x.sum(axis=0) == in_degree)
+    m.update()
+
+    m._n = n
+    m._start = start
+    m._xlist = m.getVars()
+    m.Params.LazyConstraints = 1
+    if time_limit is not None:
+        m.Params.TimeLimit = time_limit
+    m._build_time = time.time() - build_start
+
+    solve_start = time.time()
+    m.optimize(_subtour_callback)
+    m._solve_time = time.time() - solve_start
+    try:
+        solution = np.array(m.getAttr('X', m._xlist)).reshape(n, n)
+        path, subtours = _path_and_subtours(_successors(solution), start)
+
+        if DEBUG:
+            print(solution)
+            print(path)
+
+        return np.array(path, dtype=int), m.objVal, m
+    except GurobiError:
+        return 0, 0, 0
+
+
+class OvrpModel:
+    """
+    Persistent open vehicle routing problem model for a single vehicle using the Gurobi MILP optimiser. The model is
+    kept between calls to solve(), points are identified by keys so that points that disappear between replans drop
+    their variables and new points add theirs. The previous route is used as a MIP start.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the model, the next call to solve() builds it from scratch.
+        """
+        self.m = None
+        self.keys = []
+        self.vars = {}
+        self.u_vars = {}
+        self.out_constr = {}
+        self.in_constr = {}
+        self.mtz_constr = {}
+        self.big_m = 0
+        self.start = None
+        self.finish = None
+        self.cost = None
+        self.cost_keys = []
+        self.route = []
+        self.start_edges = []
+
+    def _remove_key(self, k):
+        m = self.m
+        self.keys.remove(k)
+        for j in self.keys:
+            m.remove(self.vars.pop((k, j)))
+            m.remove(self.vars.pop((j, k)))
+            m.remove(self.mtz_constr.pop((k, j)))
+            m.remove(self.mtz_constr.pop((j, k)))
+        m.remove(self.u_vars.pop(k))
+        m.remove(self.out_constr.pop(k))
+        m.remove(self.in_constr.pop(k))
+
+    def _add_vars(self, k, cost, idx):
+        m = self.m
+        i = idx[k]
+        self.u_vars[k] = m.addVar(vtype=GRB.INTEGER)
+        for j in self.keys:
+            self.vars[k, j] = m.addVar(obj=cost[i, idx[j]], vtype=GRB.BINARY)
+            self.vars[j, k] = m.addVar(obj=cost[idx[j], i], vtype=GRB.BINARY)
+
+    def _add_constrs(self, k, new_keys):
+        m = self.m
+        others = [j for j in self.keys if j != k]
+        # Existing degree constraints have to include the edges of the new point
+        for j in others:
+            if j not in new_keys:
+                m.chgCoeff(self.out_constr[j], self.vars[j, k], 1.0)
+                m.chgCoeff(self.in_constr[j], self.vars[k, j], 1.0)
+        self.out_constr[k] = m.addConstr(quicksum(self.vars[k, j] for j in others) == 1)
+        self.in_constr[k] = m.addConstr(quicksum(self.vars[j, k] for j in others) == 1)
+        for j in others:
+            if (k, j) not in self.mtz_constr:
+                self.mtz_constr[k, j] = m.addConstr(
+                    self.u_vars[k] - self.u_vars[j] + self.big_m * self.vars[k, j] <= self.big_m - 1)
+                self.mtz_constr[j, k] = m.addConstr(
+                    self.u_vars[j] - self.u_vars[k] + self.big_m * self.vars[j, k] <= self.big_m - 1)
+
+    def _update_objective(self, cost, idx):
+        # Only the costs that changed since the last call are written to the model
+        if self.cost is None:
+            return
+        common = [k for k in self.cost_keys if k in idx]
+        if len(common) == 0:
+            return
+        prev_idx = dict((k, i) for i, k in enumerate(self.cost_keys))
+        old = self.cost[np.ix_([prev_idx[k] for k in common], [prev_idx[k] for k in common])]
+        new = cost[np.ix_([idx[k] for k in common], [idx[k] for k in common])]
+        changed = np.argwhere(old != new)
+        changed = [(common[a], common[b]) for a, b in changed if a != b]
+        if len(changed) > 0:
+            self.m.setAttr('Obj', [self.vars[e] for e in changed], [float(cost[idx[e[0]], idx[e[1]]]) for e in changed])
+
+    def _set_mip_start(self, cost, keys, idx):
+        # Previous route without the points that disappeared, the new points are inserted where they are cheapest.
+        start, finish = self.start, self.finish
+        prev = [idx[k] for k in self.route if k in idx and k != start and k != finish]
+        seed = np.array([idx[start]] + prev, dtype=int)
+        seen = set(prev)
+        for k in keys:
+            if k != start and k != finish and idx[k] not in seen:
+                seed, _ = insert_cheapest(cost, np.append(seed, idx[finish]), idx[k])
+                seed = seed[:-1]
+        seed = [keys[i] for i in seed] + [finish]
+
+        for e in self.start_edges:
+            if e in self.vars:
+                self.vars[e].Start = 0
+        self.start_edges = [(seed[p], seed[p + 1]) for p in range(len(seed) - 1)]
+        for e in self.start_edges:
+            self.vars[e].Start = 1
+        for p, k in enumerate(seed):
+            self.u_vars[k].Start = p
+
+    def solve(self, cost, keys=None, start=None, finish=None, time_limit=None):
+        """
+        Solves the problem reusing the model of the previous call. Build and solve times are stored in the model as
+        _build_time and _solve_time, the build time only covers the update of the model.
+        :param cost: Cost matrix for traveling from point to point.
+        :param keys: Optional unique keys of the points of the cost matrix. If none are provided the indices are used.
+        :param start: Optional starting point for the tour. If none is provided the first point of the array is chosen
+        :param finish: Optional ending point of the tour. If none is provided the last point of the array is chosen
+        :param time_limit: Optional time budget in seconds, the best solution found within it is returned.
+        :return: Returns the route the cost and the model.
+        """
+        # Number of points
+        n = cost.shape[0]
+
+        # Check for default values
+        if keys is None:
+            keys = list(range(n))
+        keys = list(keys)
+        if start is None:
+            start = 0
+        if finish is None:
+            finish = n - 1
+
+        build_start = time.time()
+        if self.m is None:
+            self.m = Model()
+        m = self.m
+        idx = dict((k, i) for i, k in enumerate(keys))
+
+        # Drop the points that were visited or classified
+        for k in [k for k in self.keys if k not in idx]:
+            self._remove_key(k)
+
+        self._update_objective(cost, idx)
+
+        # Add the new points
+        new_keys = [k for k in keys if k not in self.u_vars]
+        for k in new_keys:
+            self._add_vars(k, cost, idx)
+            self.keys.append(k)
+        m.update()
+
+        # The big M of the sub-tour elimination constraints has to be at least the number of points
+        if n > self.big_m:
+            big_m = max(16, 2 * n)
+            for (i, j), c in self.mtz_constr.items():
+                m.chgCoeff(c, self.vars[i, j], big_m)
+                c.RHS = big_m - 1
+            self.big_m = big_m
+
+        added = set(new_keys)
+        for k in new_keys:
+            self._add_constrs(k, added)
+
+        # None enters the starting point and none exits the finish point
+        if self.start is not None and self.start in self.in_constr:
+            self.in_constr[self.start].RHS = 1
+        if self.finish is not None and self.finish in self.out_constr:
+            self.out_constr[self.finish].RHS = 1
+        self.start = keys[start]
+        self.finish = keys[finish]
+        self.in_constr[self.start].RHS = 0
+        self.out_constr[self.finish].RHS = 0
+
+        self._set_mip_start(cost, keys, idx)
+        self.cost = np.array(cost, dtype=float)
+        self.cost_keys = keys
+
+        m.Params.TimeLimit = time_limit if time_limit is not None else GRB.INFINITY
+        m.update()
+        m._build_time = time.time() - build_start
+
+        solve_start = time.time()
+        m.optimize()
+        m._solve_time = time.time() - solve_start
+        try:
+            solution = m.getAttr('X', self.vars)
+            succ = dict((i, j) for (i, j), v in solution.items() if v > 0.5)
+            route = [self.start]
+            while route[-1] in succ and len(route) < n:
+                route.append(succ[route[-1]])
+            self.route = route
+
+            return np.array([idx[k] for k in route], dtype=int), m.objVal, m
+        except GurobiError:
+            return 0, 0, 0
+
+
+def solve_ovrp(cost, start=None, finish=None, engine='auto', keys=None, warm_model=None, time_limit=None):
+    """
+    Common entry point for the OVRP engines. Falls back to the heuristic when Gurobi is not available, the MILP
+    fails to produce a solution or Gurobi raises an error, e.g. for a model too large for a size limited license.
+    :param cost: Cost matrix for traveling from point to point.
+    :param start: Optional starting point for the tour. If none is provided the first point of the array is chosen
+    :param finish: Optional ending point of the tour. If none is provided the last point of the array is chosen
+    :param engine: One of ENGINES or 'auto'.
+    :param keys: Optional unique keys of the points, used by the warm engine to match points between calls.
+    :param warm_model: OvrpModel kept by the caller between calls, used by the warm engine.
+    :param time_limit: Optional time budget in seconds, the best solution found within it is returned.
+    :return: Returns the route the cost and the model.
+    """
+    if engine == 'auto':
+        engine = 'milp' if HAS_GUROBI else 'heuristic'
+    if engine not in ENGINES:
+        raise ValueError("Unknown OVRP engine: {0}".format(engine))
+
+    if engine in ('milp', 'lazy', 'warm') and HAS_GUROBI:
+        try:
+            if engine == 'warm':
+                if warm_model is None:
+                    warm_model = OvrpModel()
+                route, total_cost, model = warm_model.solve(cost, keys, start, finish, time_limit)
+            elif engine == 'lazy':
+                route, total_cost, model = ovrp_solver_lazy(cost, start, finish, time_limit)
+            else:
+                route, total_cost, model = ovrp_solver(cost, start, finish, time_limit)
+        except GurobiError as e:
+            if DEBUG:
+                print("Gurobi error: {0}".format(e))
+            if warm_model is not None:
+                # The error can leave the model half updated
+                warm_model.reset()
+            route = None
+        if isinstance(route, np.ndarray):
+            return route, total_cost, model
+        if DEBUG:
+            print("Gurobi failed to solve the problem, falling back to the heuristic")
+
+    return ovrp_heuristic(cost, start, finish, time_limit=time_limit)
+
+
+def solve_route(cost, start=None, finish=None, engine='auto', time_limit=None):
+    """
+    Same as solve_ovrp without the model, so that the result can be sent back from a worker process.
+    :return: Returns the route and the cost.
+    """
+    route, total_cost, model = solve_ovrp(cost, start, finish, engine, time_limit=time_limit)
+    return route, total_cost
+
+
 def main():
     import time
     import matplotlib as mpl
@@ -128,7 +483,7 @@ def main():
         ax.plot(ips[:, 1], ips[:, 0], 'o', label='inspection points')
         ax.plot(ips_route[:, 1], ips_route[:, 0], 'r-', alpha=0.3)
 
-        for n in xrange(len(idx)):
+        for n in range(len(idx)):
             x, y = ips[n, 1], ips[n, 0]
             xt, yt = x - 0.10 * np.abs(x), y - 0.10 * np.abs(y)
 
@@ -160,14 +515,10 @@ def main():
     # generate random problem
     n = 12
     points = np.random.randint(-50, 50, (n, 2))
-    cities = ['c_{}'.format(k) for k in xrange(n)]
+    cities = ['c_{}'.format(k) for k in range(n)]
 
     # standard cost
-    distances = np.zeros((n, n))
-
-    for k in xrange(n):
-        for p in xrange(n):
-            distances[k, p] = np.linalg.norm(points[k, :] - points[p, :])
+    distances = distance_matrix(points)
 
     if HAS_GUROBI:
         # solve using the Gurobi solver
@@ -177,9 +528,18 @@ def main():
 
         print('Gurobi Solver')
         print('Time to Solve: %.2f secs' % dt)
+        print('Build: %.2f secs Solve: %.2f secs' % (model._build_time, model._solve_time))
         print('Cost: %.3f' % total_cost)
         print('TSP Route: %s\n' % tsp_route)
 
+        # solve using lazy sub-tour elimination
+        tsp_route_lazy, total_cost, model = ovrp_solver_lazy(distances, 1, 2)
+
+        print('Gurobi Solver (lazy sub-tour elimination)')
+        print('Build: %.2f secs Solve: %.2f secs' % (model._build_time, model._solve_time))
+        print('Cost: %.3f' % total_cost)
+        print('TSP Route: %s\n' % tsp_route_lazy)
+
 
 
 
@@ -191,6 +551,16 @@ def main():
 
         plt.show()
 
+    # solve using the heuristic
+    st = time.time()
+    tsp_route, total_cost, model = ovrp_heuristic(distances, 1, 2)
+    dt = time.time() - st
+
+    print('Heuristic Solver')
+    print('Time to Solve: %.2f secs' % dt)
+    print('Cost: %.3f' % total_cost)
+    print('TSP Route: %s\n' % tsp_route)
+
 
 if __name__ == '__main__':
     main()
@@ -1,27 +1,140 @@
 __author__ = 'nick'
 
+from collections import deque
 import simpy
 
 
 SIM_DURATION = 100
 
 
+def wrap_handler(env, handler):
+    """
+    :return: The function to call instead of a subscriber handler. A profiling environment (sim_profile) wraps the
+    handler to attribute its calls to it instead of to the flush that runs it, otherwise it is the handler itself.
+    """
+    wrap = getattr(env, 'wrap_handler', None)
+    return wrap(handler) if wrap is not None else handler
+
+
 class Pipe(object):
-    """This class represents the propagation through a cable."""
-    def __init__(self, env, delay):
+    """
+    This class represents the propagation through a cable. Messages with no delay are handed over to a waiting get
+    right away, delayed messages are delivered by the callback of a single timeout event instead of a process per
+    message. With batch set, messages put at the same time share one timeout, which suits pipes with a constant delay.
+    Delivered messages and waiting gets are kept in FIFO queues like in an unbounded simpy.Store, without the events
+    of the store puts.
+
+    Handlers registered with subscribe() receive every message without a get per message. The messages that arrive
+    at the same time are handed to the handlers by one flush event, after the step that delivered them, so handlers
+    never run inside put().
+    """
+    def __init__(self, env, delay, batch=False):
         self.env = env
         self.delay = delay
-        self.store = simpy.Store(env)
-
-    def latency(self, value):
-        yield self.env.timeout(self.delay)
-        self.store.put(value)
-
-    def put(self, value):
-        self.env.process(self.latency(value))
+        self.batch = batch
+        self.items = deque()  # Delivered messages nobody has taken yet
+        self.getters = deque()  # Get events waiting for a message
+        self.subscribers = []  # (handler, batch, function called with the messages)
+        self.arrived = []  # Messages waiting for the flush to the subscribers
+        self.flush_event = None
+        self.in_flight = {}  # Messages not delivered yet, timeout event -> (delivery time, values)
+        self.last_delivery = None
+
+    def put(self, value, delay=None):
+        """
+        :param value: Message.
+        :param delay: Optional delay of this message, the delay of the pipe by default.
+        """
+        delay = self.delay if delay is None else delay
+        if delay <= 0:
+            self.arrive(value)
+            return
+        t = self.env.now + delay
+        if self.batch:
+            last = self.in_flight.get(self.last_delivery)
+            if last is not None and last[0] == t:
+                last[1].append(value)
+                return
+        delivery = self.env.timeout(delay)
+        delivery.callbacks.append(self.deliver)
+        self.in_flight[delivery] = (t, [value])
+        self.last_delivery = delivery
+
+    def deliver(self, event):
+        t, values = self.in_flight.pop(event)
+        for value in values:
+            self.arrive(value)
+
+    def arrive(self, value):
+        if self.subscribers:
+            self.arrived.append(value)
+            self._schedule_flush()
+        elif self.getters:
+            self.getters.popleft().succeed(value)
+        else:
+            self.items.append(value)
+
+    def _schedule_flush(self):
+        if self.flush_event is None:
+            self.flush_event = self.env.event()
+            self.flush_event.callbacks.append(self.flush)
+            self.flush_event.succeed()
+
+    def flush(self, event):
+        self.flush_event = None
+        arrived, self.arrived = self.arrived, []
+        for handler, batch, call in list(self.subscribers):
+            if batch:
+                call(arrived)
+            else:
+                for value in arrived:
+                    call(value)
+
+    def subscribe(self, handler, batch=False):
+        """
+        Registers a handler that receives every message of the pipe from now on. Messages go to the subscribers
+        instead of the get() queue.
+        :param handler: Function called with the message.
+        :param batch: Call the handler once with the list of the messages that arrived at the same time instead.
+        """
+        self.subscribers.append((handler, batch, wrap_handler(self.env, handler)))
+
+    def unsubscribe(self, handler):
+        self.subscribers = [s for s in self.subscribers if s[0] != handler]
 
     def get(self):
-        return self.store.get()
+        """
+        :return: An event that succeeds with the next message.
+        """
+        event = self.env.event()
+        if self.items:
+            event.succeed(self.items.popleft())
+        else:
+            self.getters.append(event)
+        return event
+
+    def get_state(self):
+        """
+        :return: The pending messages as (delivery time, value) in delivery order, including the delivered ones
+        nobody has taken yet.
+        """
+        pending = [(self.env.now, value) for value in self.arrived]
+        pending.extend((self.env.now, value) for value in self.items)
+        pending.extend(self._in_flight_messages())
+        return pending
+
+    def _in_flight_messages(self):
+        pending = []
+        for t, values in sorted(self.in_flight.values(), key=lambda m: m[0]):
+            pending.extend((t, value) for value in values)
+        return pending
+
+    def set_state(self, pending):
+        """
+        Puts the pending messages of get_state back into the pipe with their remaining delay.
+        """
+        for t, value in pending:
+            self.put(value, max(0, t - self.env.now))
 
 
 def sender(env, cable):
@@ -2,54 +2,40 @@ __author__ = 'nick'
 
 import simpy
 
+from pipe import Pipe
+from sim_trace import tracer, STATE, MSG, ALL, STATE_CHANGE, MSG_SENT, MSG_RECEIVED
 
-SIM_DURATION = 100
-
-
-class Pipe(object):
-    """This class represents the propagation through a cable."""
-    def __init__(self, env, delay):
-        self.env = env
-        self.delay = delay
-        self.store = simpy.Store(env)
 
-    def latency(self, value):
-        yield self.env.timeout(self.delay)
-        self.store.put(value)
-
-    def put(self, value):
-        self.env.process(self.latency(value))
-
-    def get(self):
-        return self.store.get()
+SIM_DURATION = 100
 
 
 class Receiver:
+    # States in the trace
+    working = 0
+    interrupted = 1
+
     def __init__(self, env, cable):
         self.env = env
         self.cable = cable
+        self.trace_id = tracer.intern("receiver")
         self.action = env.process(self.run())
-        self.msg_event = self.cable.get()
-        self.msg_event.callbacks.append(self.msg_callback)
+        self.cable.subscribe(self.msg_callback)
         self.msg_rcv = False
 
-    def msg_callback(self, event):
-        self.msg_event = self.cable.get()
-        self.msg_event.callbacks.append(self.msg_callback)
-        print("Got message at {0} saying {1}".format(self.env.now, event.value))
+    def msg_callback(self, msg):
+        if tracer.enabled & MSG:
+            tracer.emit_message(self.env.now, MSG_RECEIVED, self.trace_id, msg)
         # self.action.interrupt()
         self.msg_rcv = True
 
     def run(self):
         while True:
-            self.msg_event = self.cable.get()
-            self.msg_event.callbacks.append(self.msg_callback)
             self.msg_rcv = False
             try:
-                print("Doing normal work at {0}".format(self.env.now))
                 yield self.env.timeout(20)
             except simpy.Interrupt:
-                print("Interrupted!!!")
+                if tracer.enabled & STATE:
+                    tracer.emit(self.env.now, STATE_CHANGE, self.trace_id, self.working, self.interrupted)
 
 
 def main():
@@ -58,12 +44,15 @@ def main():
         while True:
             # wait for next transmission
             yield env.timeout(5)
-            print("Put message to pipe at {0}".format(env.now))
-            cable.put('Sender sent this at %d' % env.now)
+            msg = 'Sender sent this at %d' % env.now
+            if tracer.enabled & MSG:
+                tracer.emit_message(env.now, MSG_SENT, sender_id, msg)
+            cable.put(msg)
 
 
     def __msg_callback(event):
-        print("Received message at {0} saying {1}".format(env.now, event.value))
+        if tracer.enabled & MSG:
+            tracer.emit_message(env.now, MSG_RECEIVED, sender_id, event.value)
 
     # def __receiver(env, cable):
     #     """A process which consumes messages."""
@@ -89,12 +78,15 @@ def main():
     # Setup and start the simulation
     print('Event Latency')
     env = simpy.Environment()
+    tracer.enable(ALL)
+    sender_id = tracer.intern("sender")
 
     cable = Pipe(env, 2)
     env.process(__sender(env, cable))
     # env.process(__receiver(env, cable))
     receiver = Receiver(env, cable)
     env.run(until=SIM_DURATION)
+    tracer.dump()
 
 if __name__=="__main__":
     main()
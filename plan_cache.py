@@ -0,0 +1,59 @@
+__author__ = 'nick'
+
+# Memoization of route plans. A plan is reused when the same set of targets is planned again from (roughly) the same
+# start position.
+
+from collections import OrderedDict
+import numpy as np
+
+
+class PlanCache:
+    """
+    Bounded LRU cache of target orders keyed on the set of target ids and the quantized start position.
+    """
+
+    def __init__(self, maxsize=128, resolution=10.0):
+        """
+        :param maxsize: Maximum number of cached plans, the least recently used plan is evicted first.
+        :param resolution: Size in meters of the grid the start position is quantized to.
+        """
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.plans)
+
+    def key(self, target_ids, start):
+        cell = np.floor(np.asarray(start, dtype=float) / self.resolution).astype(int)
+        return frozenset(target_ids), tuple(cell.tolist())
+
+    def get(self, key):
+        """
+        :param key: Key returned by key().
+        :return: The cached order as a list of target ids or None on a miss.
+        """
+        order = self.plans.pop(key, None)
+        if order is None:
+            self.misses += 1
+            return None
+        self.plans[key] = order
+        self.hits += 1
+        return order
+
+    def put(self, key, order):
+        """
+        :param key: Key returned by key().
+        :param order: The order as a list of target ids.
+        """
+        self.plans.pop(key, None)
+        self.plans[key] = list(order)
+        while len(self.plans) > self.maxsize:
+            self.plans.popitem(last=False)
+
+    def clear(self):
+        self.plans.clear()
+        self.hits = 0
+        self.misses = 0
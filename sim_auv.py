@@ -3,9 +3,6 @@ __author__ = 'nick'
 import simpy
 import math
 import angles
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
 import time
 import os
@@ -13,11 +10,20 @@ import os
 from pipe import Pipe
 from msgs import *
 from target import Target
+from target_registry import TargetRegistry, PlanCursor
+from trajectory import Trajectory
+from trajectory_recorder import TrajectoryRecorder, plot_tracks
+from cost_matrix import CostMatrix
+from ovrp_heuristic import cheapest_insertion
+from ovrp_fleet import solve_partition
+from sim_trace import tracer, STATE, MSG, INSPECT, NAV, STATE_CHANGE, MSG_SENT, MSG_RECEIVED, INSPECT_START, \
+    INSPECT_END, NAV_UPDATE, ALL
 
-# DEBUG = os.environ.get('DEBUG', None) == "True"
 # PLOT = os.environ.get('PLOT', None) == "True"
-DEBUG = False
 PLOT = True
+TRACE = ALL  # Trace categories recorded by main
+TRACK_FILE = "sim_auv_tracks.npz"
+TRACE_FILE = "sim_auv_trace.npz"
 
 
 def get_euclidean3d(p1, p2):
@@ -55,70 +61,81 @@ class AuvExecutor:
     curr_lin_vel = 0
     curr_rot_vel = 0
 
-    plan_msg_event = 0
-    nav_msg_event = 0
+    wake_event = None
 
     def __init__(self, env, name, plan_request, plan_feedback, nav_req, nav_update):
         self.env = env
         self.name = name
+        # Mutable state must not be shared between vehicles through the class attributes
+        self.curr_pos = [0, 0, 0]
+        self.target_list = []
+        self.target_order = []
+        self.plan = PlanCursor()
+        self.plan_version = 0
+        self.plan_mismatches = 0  # Plan deltas dropped because they were for another plan version
+        self.plans_received = 0
+        self.inspections = 0
+        self.last_inspection_time = None
+        self.inspection_end = None  # End of the current inspection
+        self.trajectory = Trajectory()
+        self.pilot = None
+        self.pilot_action = None
         self.plan_request = plan_request
         self.plan_feedback = plan_feedback
-        self.plan_msg_event = self.plan_request.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_msg)
+        self.plan_request.subscribe(self.handle_plan_msg)
         self.nav_req = nav_req
-        self.nav_msg_event = self.nav_req.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_req)
+        self.nav_req.subscribe(self.handle_nav_req)
         self.nav_update = nav_update
-        if DEBUG:
-            print("Initialised vehicle {0}".format(name))
+        self.trace_id = tracer.intern(name)
         self.action = env.process(self.run())
 
     def run(self):
         while True:
             # State machine
 
+            if tracer.enabled & STATE and self.next_state != self.curr_state:
+                tracer.emit(self.env.now, STATE_CHANGE, self.trace_id, self.curr_state, self.next_state)
             self.curr_state = self.next_state
             if self.curr_state == self.idle:
                 # Do what you have to do when idle
-                has_targets = False
-                if len(self.target_order) > 0:
-                    if DEBUG:
-                        print("In state idle, number of targets: {0}".format(len(self.target_list)))
-                    while not has_targets and len(self.target_order) > 0:
-                        self.curr_target = self.target_list[self.target_order[0]]
-                        has_targets = True
-                        if self.curr_target.classification != "None":
-                            if DEBUG:
-                                print("Target already classified, skipping")
-                            self.target_order.pop(0)
-                            has_targets = False
-                if has_targets:
-                    if DEBUG:
-                        print("Next target is at: ", self.curr_target.ned_pos)
+                # Classified targets, including the one just inspected, are skipped by the cursor
+                next_target = self.plan.next_unclassified()
+                if next_target is not None:
+                    self.curr_target = next_target
                     self.next_state = self.navigate_to_target
-                    if DEBUG:
-                        print("Next state: ", self.next_state)
                 else:
                     self.next_state = self.idle
-                    if DEBUG:
-                        print("Waiting for targets")
-                    yield self.env.timeout(1)
+                    # Sleep until something wakes the vehicle up, e.g. a new plan
+                    self.wake_event = self.env.event()
+                    yield self.wake_event
             elif self.curr_state == self.navigate_to_target:
                 # Do what you have to do when navigating to target
                 try:
-                    yield self.env.process(self.send_pilot_req(self.curr_target.ned_pos))
+                    self.pilot = self.env.process(self.send_pilot_req(self.curr_target.ned_pos))
+                    yield self.pilot
                     self.next_state = self.inspect_target
                 except simpy.Interrupt:
+                    if self.pilot.is_alive:
+                        self.pilot.interrupt()
                     self.next_state = self.idle
             elif self.curr_state == self.inspect_target:
                 # Inspection is simulated as waiting at the spot for the moment. Will create an action later
-                print("Vehicle {0} starting inspection at point {1} at time {2}".format(self.name, self.curr_pos,
-                                                                                        self.env.now))
-                yield self.env.timeout(self.inspection_duration)
-                print("Vehicle {0} finished inspection at {1}. Found a mine!".format(self.name, self.env.now))
+                if self.inspection_end is None:
+                    # Not resuming an inspection from a snapshot
+                    self.inspection_end = self.env.now + self.inspection_duration
+                    if tracer.enabled & INSPECT:
+                        tracer.emit(self.env.now, INSPECT_START, self.trace_id, self.curr_target.id)
+                yield self.env.timeout(self.inspection_end - self.env.now)
+                self.inspection_end = None
                 self.curr_target.classification = "Mine"
-                self.plan_feedback.put(PlanFeedbackMsg(self.curr_target.id, self.curr_target.classification))
-                self.target_order.pop(0)
+                if tracer.enabled & INSPECT:
+                    tracer.emit(self.env.now, INSPECT_END, self.trace_id, self.curr_target.id)
+                self.inspections += 1
+                self.last_inspection_time = self.env.now
+                msg = PlanFeedbackMsg(self.curr_target.id, self.curr_target.classification)
+                if tracer.enabled & MSG:
+                    tracer.emit_message(self.env.now, MSG_SENT, self.trace_id, msg)
+                self.plan_feedback.put(msg)
                 self.next_state = self.idle
             else:
                 # You shouldn't be here print error message and default to idle state
@@ -134,30 +151,39 @@ class AuvExecutor:
         turn = angles.normalize(norm_yaw - turn_deg, -180, 180)
         turn = angles.d2r(turn)
 
-        yield self.env.process(self.rotate(turn))
+        try:
+            self.pilot_action = self.env.process(self.rotate(turn))
+            yield self.pilot_action
+        except simpy.Interrupt:
+            # The pose was already set where the vehicle stopped
+            if self.pilot_action.is_alive:
+                self.pilot_action.interrupt()
+            return
 
         self.curr_yaw += turn
         self.curr_yaw = angles.d2r(angles.normalize(angles.r2d(self.curr_yaw), -180, 180))
 
-        if DEBUG:
-            print("Vehicle {0} yaw: {1}".format(self.name, self.curr_yaw))
-
         dist = get_euclidean3d(pos, self.curr_pos)
-        yield self.env.process(self.move(dist))
+        try:
+            self.pilot_action = self.env.process(self.move(dist, pos))
+            yield self.pilot_action
+        except simpy.Interrupt:
+            if self.pilot_action.is_alive:
+                self.pilot_action.interrupt()
+            return
 
         self.curr_pos = pos
 
-        if DEBUG:
-            print("Vehicle {0} position: {1}".format(self.name, self.curr_pos))
-
-    def move(self, distance):
+    def move(self, distance, pos):
         time = distance / self.linear_vel
         self.curr_lin_vel = self.linear_vel
         self.action_start = self.env.now
         self.expected_timeout = self.env.now + time
-        if DEBUG:
-            print("Move time: ", time)
-        yield self.env.timeout(time)
+        self.trajectory.translate(self.env.now, time, self.get_pose(), pos)
+        try:
+            yield self.env.timeout(time)
+        except simpy.Interrupt:
+            pass
         self.curr_lin_vel = 0
 
     def rotate(self, angle):
@@ -165,58 +191,107 @@ class AuvExecutor:
         self.curr_rot_vel = self.rot_vel
         self.action_start = self.env.now
         self.expected_timeout = self.env.now + time
-        if DEBUG:
-            print("Rotate time: ", time)
-        yield self.env.timeout(time)
+        self.trajectory.rotate(self.env.now, time, self.get_pose(), angle)
+        try:
+            yield self.env.timeout(time)
+        except simpy.Interrupt:
+            pass
         self.curr_rot_vel = 0
 
+    def get_pose(self):
+        """
+        :return: The pose [north, east, down, yaw] at the start of the current action.
+        """
+        return [self.curr_pos[0], self.curr_pos[1], self.curr_pos[2], self.curr_yaw]
+
     def get_position(self):
-        if self.curr_lin_vel > 0:
-            # Vehicle is currently moving so must extrapolate
-            return [
-                np.interp(self.env.now, [self.action_start, self.expected_timeout], [self.curr_pos[0], self.curr_target.ned_pos[0]]),
-                np.interp(self.env.now, [self.action_start, self.expected_timeout], [self.curr_pos[1], self.curr_target.ned_pos[1]]),
-                np.interp(self.env.now, [self.action_start, self.expected_timeout], [self.curr_pos[2], self.curr_target.ned_pos[2]])
-            ]
-        else:
+        if len(self.trajectory) == 0:
             return self.curr_pos
-
-    def handle_plan_msg(self, event):
-        self.plan_msg_event = self.plan_request.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_msg)
-        if self.curr_state == self.navigate_to_target:
-            self.curr_pos = self.get_position()
+        # Closed form evaluation of the trajectory segment the vehicle is in
+        return self.trajectory.position_at(self.env.now).tolist()
+
+    def wake(self):
+        """
+        Wakes the vehicle up if it is waiting in the idle state.
+        """
+        if self.wake_event is not None and not self.wake_event.triggered:
+            self.wake_event.succeed()
+
+    def stop(self):
+        """
+        Stops the navigation where the vehicle is, in the middle of a rotation or a translation. The vehicle goes
+        back to idle and picks the next target of its plan.
+        """
+        if self.curr_state == self.navigate_to_target and self.next_state != self.idle:
+            pose = self.trajectory.pose_at(self.env.now)
+            self.trajectory.truncate(self.env.now)
+            self.curr_pos = pose[:3].tolist()
+            self.curr_yaw = pose[3]
+            self.next_state = self.idle
             self.action.interrupt()
-        self.target_list = event.value.target_list
-        self.target_order = event.value.target_order
 
-    def handle_nav_req(self, event):
-        self.nav_msg_event = self.nav_req.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_req)
+    def handle_plan_msg(self, msg):
+        if tracer.enabled & MSG:
+            tracer.emit_message(self.env.now, MSG_RECEIVED, self.trace_id, msg)
+        if isinstance(msg, PlanDeltaMsg):
+            if msg.base_version != self.plan_version:
+                # The delta is for another plan, keep the current one until a full plan comes
+                self.plan_mismatches += 1
+                return
+            # The plan is changed in place, the vehicle only stops if its next target changed
+            self.plan.apply(msg.ops)
+            if self.curr_state == self.navigate_to_target and self.plan.next_unclassified() is not self.curr_target:
+                self.stop()
+        else:
+            self.stop()
+            self.plan = PlanCursor(msg.target_list, msg.target_order)
+            self.target_list = self.plan.target_list
+            self.target_order = self.plan.target_order
+        self.plan_version = msg.version
+        self.plans_received += 1
+        self.wake()
+
+    def handle_nav_req(self, msg):
         current_pos = self.get_position()
+        if tracer.enabled & NAV:
+            tracer.emit(self.env.now, NAV_UPDATE, self.trace_id, *current_pos)
         self.nav_update.put(NavUpdateMsg(current_pos))
 
-
-def position_printer(env, veh, ax):
-    ax.set_xlabel("East")
-    ax.set_ylabel("North")
-    ax.set_zlabel("Depth")
-    ax.hold(True)
-    ax.grid(True)
-    first_time = True
-    prev_pos = 0
-    while True:
-        if first_time:
-            ax.scatter(veh.get_position()[1], veh.get_position()[0], veh.get_position()[2], 'o', label='inspection points')
-            first_time = False
-            prev_pos = veh.get_position()
-        else:
-            if not prev_pos == veh.get_position():
-                ax.scatter(veh.get_position()[1], veh.get_position()[0], veh.get_position()[2], 'o', label='inspection points')
-                prev_pos = veh.get_position()
-                # print(veh.get_position())
-
-        yield env.timeout(10)
+    def get_state(self):
+        """
+        :return: The state needed to resume the vehicle with set_state. A navigation is resumed from the current pose.
+        """
+        state = self.curr_state
+        if state == self.navigate_to_target and self.next_state == self.idle:
+            # Interrupted by a new plan, the interrupt has not been handled yet
+            state = self.idle
+        pose = self.trajectory.pose_at(self.env.now) if len(self.trajectory) > 0 else self.get_pose()
+        return {'state': state, 'pose': [float(v) for v in pose], 'curr_target': self.curr_target,
+                'target_list': self.target_list, 'target_order': self.target_order, 'plan': self.plan,
+                'plan_version': self.plan_version,
+                'inspection_end': self.inspection_end, 'plans_received': self.plans_received,
+                'inspections': self.inspections, 'last_inspection_time': self.last_inspection_time,
+                'trajectory': self.trajectory}
+
+    def set_state(self, state):
+        """
+        Restores a state of get_state. Has to be called right after the vehicle is created, before the simulation
+        runs.
+        """
+        self.next_state = state['state']
+        self.curr_pos = state['pose'][:3]
+        self.curr_yaw = state['pose'][3]
+        self.curr_target = state['curr_target']
+        self.target_list = state['target_list']
+        self.target_order = state['target_order']
+        self.plan = state['plan']
+        self.plan_version = state['plan_version']
+        self.inspection_end = state['inspection_end']
+        self.plans_received = state['plans_received']
+        self.inspections = state['inspections']
+        self.last_inspection_time = state['last_inspection_time']
+        self.trajectory = state['trajectory']
+        self.trajectory.truncate(self.env.now)
 
 
 class TargetGenerator:
@@ -225,79 +300,168 @@ class TargetGenerator:
     targets = np.array([[1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 0], [-1, 0, 0], [-1, -1, 0], [0, -1, 0], [0, 0, 0]])
     targets = targets*100
     targets = targets.tolist()
-    targets_list = []
-    uid = 0
 
-    def __init__(self, env, plan_req, plan_fb, nav_req, nav_update):
+    # A new target is inserted in the current plan at its cheapest position. A full re-solve is done when the
+    # insertion costs more than replan_threshold times the mean leg of the current plan.
+    replan_threshold = 2.0
+    engine = 'auto'
+    use_deltas = True  # Send plan changes as PlanDeltaMsg after the first plan
+    full_plan_interval = 10  # Every full_plan_interval plans is sent in full, which resyncs the executor after a loss
+    generation_period = 120  # A new target appears every generation_period seconds
+
+    def __init__(self, env, plan_req, plan_fb, nav_req, nav_update, targets=None):
         self.env = env
+        # Targets are popped as they are generated so each generator needs its own copy
+        self.targets = [list(pos) for pos in (targets if targets is not None else TargetGenerator.targets)]
+        self.vehicle_pos = [0, 0, 0]
+        self.next_tick = 0  # Time of the next target generation
+        self.plan = []  # Current plan as target ids
+        self.plan_version = 0
+        self.resync = False  # The executor missed a plan, the next one is sent in full
+        self.cost_matrix = CostMatrix()
+        self.registry = TargetRegistry()
         self.plan_req = plan_req
         self.plan_fb = plan_fb
-        self.plan_msg_event = self.plan_fb.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_feedback)
+        self.plan_fb.subscribe(self.handle_plan_feedback)
         self.nav_req = nav_req
         self.nav_update = nav_update
-        self.nav_msg_event = self.nav_update.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_update)
-        if DEBUG:
-            print("Initialised")
+        self.nav_update.subscribe(self.handle_nav_update)
+        self.trace_id = tracer.intern("generator")
         self.action = env.process(self.run())
 
-    def handle_plan_feedback(self, event):
-        self.plan_msg_event = self.plan_fb.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_feedback)
-        self.targets_list[event.value.target_id][1].classification = event.value.target_class
-        print("The AUV has classified target {0} with class {1}".format(event.value.target_id, self.targets_list[event.value.target_id][1].classification))
-
-    def handle_nav_update(self, event):
-        self.nav_msg_event = self.nav_update.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_update)
-        print("The vehicle is at {0}".format(event.value.pos))
+    def handle_plan_feedback(self, msg):
+        self.registry.classify(msg.target_id, msg.target_class)
+        self.cost_matrix.discard(msg.target_id)
+        if tracer.enabled & MSG:
+            tracer.emit_message(self.env.now, MSG_RECEIVED, self.trace_id, msg)
+
+    def handle_nav_update(self, msg):
+        if tracer.enabled & NAV:
+            tracer.emit(self.env.now, NAV_UPDATE, self.trace_id, *msg.pos)
+        self.vehicle_pos = msg.pos
+
+    def update_plan(self, new_ids):
+        """
+        Updates the plan with the new targets. A single new target is inserted at its cheapest position, which only
+        needs the costs along the plan and to the new target, otherwise or when the insertion is too expensive the
+        plan is solved again.
+        :param new_ids: Ids of the targets added since the last plan.
+        :return: The ids of the unclassified targets and the plan as indices into them.
+        """
+        target_ids = self.registry.unclassified_ids()
+        plan = [k for k in self.plan if not self.registry.is_classified(k)]
+        full_solve = len(new_ids) != 1 or len(plan) != len(target_ids) - 1
+        if not full_solve:
+            legs = self.cost_matrix.route_legs(plan, self.vehicle_pos)
+            mean_leg = legs.sum() / len(legs) if len(legs) > 0 else 0.0
+            costs = self.cost_matrix.costs_to(new_ids[0], plan, self.vehicle_pos)
+            k, delta = cheapest_insertion(legs, costs, costs, open_end=True)
+            if len(plan) > 1 and delta > self.replan_threshold * mean_leg:
+                full_solve = True
+            else:
+                plan.insert(k, new_ids[0])
+                position = dict((key, i) for i, key in enumerate(target_ids))
+                order = [position[key] for key in plan]
+        if full_solve:
+            order = solve_partition(self.vehicle_pos, self.cost_matrix.positions(target_ids), self.engine)
+            plan = [target_ids[i] for i in order]
+        self.plan = plan
+        return target_ids, order
+
+    def plan_message(self, old_plan, target_ids, order):
+        """
+        Message that takes the executor from the old plan to the current one. A plan that only adds targets to the
+        old plan is sent as insertions, one that changes the order as the insertions and the new order. Only target
+        ids are sent for the targets the executor already has.
+        :param old_plan: Plan of the previous message as target ids.
+        :param target_ids: Ids of the unclassified targets.
+        :param order: Current plan as indices into target_ids.
+        :return: A PlanReqMsg or a PlanDeltaMsg.
+        """
+        base_version = self.plan_version
+        self.plan_version += 1
+        if not self.use_deltas or self.resync or base_version % self.full_plan_interval == 0:
+            self.resync = False
+            return PlanReqMsg([self.registry[i] for i in target_ids], order, self.plan_version)
+        unclassified = set(target_ids)
+        old_plan = [k for k in old_plan if k in unclassified]
+        known = set(old_plan)
+        if [k for k in self.plan if k in known] == old_plan:
+            ops = [(PLAN_INSERT, self.registry[k], self.plan[i - 1] if i > 0 else None)
+                   for i, k in enumerate(self.plan) if k not in known]
+        else:
+            ops = [(PLAN_INSERT, self.registry[k], None) for k in self.plan if k not in known]
+            ops.append((PLAN_REORDER, list(self.plan)))
+        return PlanDeltaMsg(base_version, self.plan_version, ops)
+
+    def get_state(self):
+        """
+        :return: The state needed to resume the generator with set_state.
+        """
+        return {'targets': self.targets, 'vehicle_pos': self.vehicle_pos, 'next_tick': self.next_tick,
+                'plan': self.plan, 'plan_version': self.plan_version, 'resync': self.resync,
+                'cost_matrix': self.cost_matrix,
+                'registry': self.registry}
+
+    def set_state(self, state):
+        self.targets = state['targets']
+        self.vehicle_pos = state['vehicle_pos']
+        self.next_tick = state['next_tick']
+        self.plan = state['plan']
+        self.plan_version = state['plan_version']
+        self.resync = state['resync']
+        self.cost_matrix = state['cost_matrix']
+        self.registry = state['registry']
 
     def run(self):
+        if self.next_tick > self.env.now:
+            # Resumed from a snapshot
+            yield self.env.timeout(self.next_tick - self.env.now)
         while True:
-            # self.msg_event = self.plan_fb.get()
-            # self.msg_event.callbacks.append(self.handle_plan_feedback)
             self.nav_req.put(NavReqMsg())
             if len(self.targets) > 0:
                 # There are more targets to generate
-                self.targets_list.append([self.uid, Target(self.uid, self.targets.pop(0))])
-                self.uid += 1
-
-                unclassified_targets = []
-                for i in range(len(self.targets_list)):
-                    if self.targets_list[i][1].classification == "None":
-                        unclassified_targets.append([i, self.targets_list[i][1]])
-                if len(unclassified_targets) > 0:
+                target = self.registry.add(self.targets.pop(0))
+                self.cost_matrix.add(target.id, target.ned_pos)
+
+                if self.registry.unclassified:
                     # Should create a plan
-                    targets_order = range(len(unclassified_targets))
-                    target_list = []
-                    for i in range(len(unclassified_targets)):
-                        target_list.append(unclassified_targets[i][1])
-                    self.plan_req.put(PlanReqMsg(target_list, targets_order))
-            yield self.env.timeout(120)
+                    old_plan = self.plan
+                    target_ids, targets_order = self.update_plan([target.id])
+                    msg = self.plan_message(old_plan, target_ids, targets_order)
+                    if tracer.enabled & MSG:
+                        tracer.emit_message(self.env.now, MSG_SENT, self.trace_id, msg)
+                    if self.plan_req.put(msg) is False:
+                        # Rejected by a full channel, a delta on top of this plan would not apply
+                        self.resync = True
+            self.next_tick = self.env.now + self.generation_period
+            yield self.env.timeout(self.generation_period)
 
 
 def main():
     # Simulation setup
     start = time.time()
     env = simpy.Environment()
+    tracer.enable(TRACE)
 
     # Process cabling
     plan_request = Pipe(env, 0)
     plan_feedback = Pipe(env, 0)
     nav_req = Pipe(env, 0)
     nav_update = Pipe(env, 0)
-    fig, ax = plt.subplots()
-    ax = fig.add_subplot(111, projection='3d')
 
     tg = TargetGenerator(env, plan_request, plan_feedback, nav_req, nav_update)
     auv1 = AuvExecutor(env, "auv1", plan_request, plan_feedback, nav_req, nav_update)
 
-    if PLOT:
-        env.process(position_printer(env, auv1, ax))
+    recorder = TrajectoryRecorder()
+    env.process(recorder.sampler(env, [auv1]))
     env.run(until=3600)
     print(time.time()-start)
+    recorder.save(TRACK_FILE)
+    tracer.save(TRACE_FILE)
     if PLOT:
+        import matplotlib.pyplot as plt
+        plot_tracks(recorder.track_dict())
         plt.show()
 
 if __name__ == "__main__":
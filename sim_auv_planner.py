@@ -3,41 +3,74 @@ __author__ = 'nick'
 import simpy
 import numpy as np
 import time
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 from ovrp_solver import *
+from cost_matrix import CostMatrix
+from ovrp_fleet import solve_fleet
+from plan_cache import PlanCache
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from msgs import *
 from target import Target
+from target_registry import TargetRegistry
 from pipe import Pipe
-from sim_auv import AuvExecutor, get_euclidean3d, position_printer
+from sim_auv import AuvExecutor, get_euclidean3d
+from trajectory_recorder import TrajectoryRecorder, plot_tracks
+from sim_trace import tracer, MSG, PLAN, NAV, MSG_SENT, MSG_RECEIVED, PLAN_SOLVED, PLAN_CACHED, NAV_UPDATE, ALL
 
-DEBUG = True
+TEST_TARGETS = True  # Load the test targets when the planner is not given any
 PLOT = True
-# DEBUG = os.environ.get('DEBUG', None) == "True"
+TRACE = ALL  # Trace categories recorded by main
+TRACK_FILE = "sim_auv_planner_tracks.npz"
+TRACE_FILE = "sim_auv_planner_trace.npz"
 # PLOT = os.environ.get('PLOT', None) == "True"
 
 
 class AuvPlanner:
 
     planer_timeout = 100  # Planner rate 0.1 Hz to check.
+    engine = 'auto'  # OVRP engine, see ovrp_solver.ENGINES. 'auto' falls back to the heuristic without Gurobi.
+    time_budget = None  # Wall clock budget of the solver in seconds, None solves to completion.
+    background = False  # Solve in a process pool while the simulation keeps running.
+
+    # Simulated planning time, compute_time_base + compute_time_per_target * n seconds. It is charged instead of the
+    # measured wall clock time so that the simulation does not depend on the host speed.
+    compute_time_base = 1.0
+    compute_time_per_target = 0.1
 
     env = 0
     plan_request = 0
     plan_feedback = 0
 
-    def __init__(self, env, plan_request, plan_feedback, nav_req, nav_update):
+    def __init__(self, env, plan_request, plan_feedback, nav_req, nav_update, engine='auto', time_budget=None,
+                 background=False, workers=None, targets=None):
         self.env = env
+        self.engine = engine
+        self.time_budget = time_budget
+        self.background = background
+        self.workers = workers
+        self.pool = None
+        self.pending = None
+        self.pending_future = None
         self.plan_request = plan_request
         self.plan_feedback = plan_feedback
-        self.plan_msg_event = self.plan_feedback.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_feedback)
+        self.plan_feedback.subscribe(self.handle_plan_feedback)
         self.nav_req = nav_req
         self.nav_update = nav_update
-        self.nav_msg_event = self.nav_update.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_update)
+        self.nav_update.subscribe(self.handle_nav_update)
         self.vehicle_pos = [0, 0, 0]
         self.got_nav = False
-        if DEBUG:
+        self.next_tick = 0  # Time the planner checks for new targets next
+        self.cycle = None  # Phase of the planning cycle in progress, see plan_cycle
+        self.cost_matrix = CostMatrix()
+        self.registry = TargetRegistry()
+        self.warm_model = OvrpModel()
+        self.plan_cache = PlanCache()
+        self.new_targets = False
+        self.trace_id = tracer.intern("planner")
+        if targets is not None:
+            for pos in targets:
+                self.add_target(pos)
+        elif TEST_TARGETS:
             self.__testing__()
         self.action = env.process(self.run())
 
@@ -47,97 +80,270 @@ class AuvPlanner:
         self.targets = np.array([[1, 0, -1], [1, 1, -1], [0, 1, 0], [0, 0, 0], [-1, 0, 0], [-1, -1, 0], [0, -1, 0], [0, 0, 0]])
         self.targets = self.targets*100
         self.targets = self.targets.tolist()
-        self.targets_list = []
-        self.uid = 0
         for i in range(len(self.targets)):
-            self.targets_list.append([self.uid, Target(self.uid, self.targets.pop(0))])
-            self.uid += 1
+            self.add_target(self.targets.pop(0))
+
+    def add_target(self, pos):
+        target = self.registry.add(pos)
+        self.cost_matrix.add(target.id, target.ned_pos)
+        self.new_targets = True
+        return target
+
+    def plan_in_background(self, distances, target_ids, cache_key=None):
+        """
+        Submits the OVRP to the process pool. A newer job supersedes the pending one, which is cancelled.
+        :param distances: Cost matrix with the vehicle as the first point.
+        :param target_ids: Ids of the targets of the cost matrix.
+        :param cache_key: Optional plan cache key the plan is stored under.
+        :return: A SimPy process that finishes with the plan request once the job is done and the simulated planning
+        time has passed, or with None if it was superseded.
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+        if self.pending is not None and self.pending.is_alive:
+            self.pending_future.cancel()
+            self.pending.interrupt()
+        # The warm model lives in this process so the workers solve from scratch
+        engine = self.engine if self.engine != 'warm' else 'auto'
+        self.pending_future = self.pool.submit(solve_route, distances, engine=engine, time_limit=self.time_budget)
+        self.pending = self.env.process(self._wait_plan(self.pending_future, target_ids, cache_key))
+        return self.pending
+
+    def _wait_plan(self, future, target_ids, cache_key):
+        compute_time = self.compute_time(len(target_ids))
+        try:
+            yield self.env.timeout(compute_time)
+        except simpy.Interrupt:
+            return None
+        # Only blocks if the job takes longer than the simulated planning time
+        tsp_route, total_cost = future.result()
+        target_order = [int(i) - 1 for i in tsp_route[1:]]
+        if tracer.enabled & PLAN:
+            tracer.emit(self.env.now, PLAN_SOLVED, self.trace_id, len(target_ids), compute_time)
+        if cache_key is not None:
+            self.plan_cache.put(cache_key, [target_ids[i] for i in target_order])
+        msg = PlanReqMsg([self.registry[i] for i in target_ids], target_order)
+        self.send_plan(msg)
+        return msg
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def compute_time(self, n):
+        compute_time = self.compute_time_base + self.compute_time_per_target * n
+        if self.time_budget is not None:
+            compute_time = min(compute_time, self.time_budget)
+        return compute_time
+
+    def get_state(self):
+        """
+        :return: The state needed to resume the planner with set_state. A background job in progress is not saved,
+        the resumed planner plans again at the time of the snapshot instead.
+        """
+        background = self.pending is not None and self.pending.is_alive
+        return {'vehicle_pos': self.vehicle_pos, 'got_nav': self.got_nav, 'cycle': self.cycle,
+                'new_targets': self.new_targets or background,
+                'next_tick': self.env.now if background else self.next_tick, 'cost_matrix': self.cost_matrix,
+                'registry': self.registry, 'plan_cache': self.plan_cache}
 
-    def handle_plan_feedback(self, event):
-        self.plan_msg_event = self.plan_feedback.get()
-        self.plan_msg_event.callbacks.append(self.handle_plan_feedback)
-        self.targets_list[event.value.target_id][1].classification = event.value.target_class
+    def set_state(self, state):
+        """
+        Restores a state of get_state. Has to be called right after the planner is created, before the simulation
+        runs. The warm start model is not part of the state and starts empty.
+        """
+        self.vehicle_pos = state['vehicle_pos']
+        self.got_nav = state['got_nav']
+        self.cycle = state['cycle']
+        self.new_targets = state['new_targets']
+        self.next_tick = state['next_tick']
+        self.cost_matrix = state['cost_matrix']
+        self.registry = state['registry']
+        self.plan_cache = state['plan_cache']
 
-    def handle_nav_update(self, event):
+    def send_plan(self, msg):
+        if tracer.enabled & MSG:
+            tracer.emit_message(self.env.now, MSG_SENT, self.trace_id, msg)
+        self.plan_request.put(msg)
+
+    def handle_plan_feedback(self, msg):
+        if tracer.enabled & MSG:
+            tracer.emit_message(self.env.now, MSG_RECEIVED, self.trace_id, msg)
+        self.registry.classify(msg.target_id, msg.target_class)
+        self.cost_matrix.discard(msg.target_id)
+
+    def handle_nav_update(self, msg):
         self.got_nav = True
-        self.nav_msg_event = self.nav_update.get()
-        self.nav_msg_event.callbacks.append(self.handle_nav_update)
-        if DEBUG:
-            print("Vehicle at {0}".format(event.value.pos))
-        self.vehicle_pos = event.value.pos
+        if tracer.enabled & NAV:
+            tracer.emit(self.env.now, NAV_UPDATE, self.trace_id, *msg.pos)
+        self.vehicle_pos = msg.pos
 
     def run(self):
-        # new_targets = True
-        first_time = True
+        resume = self.cycle
         while True:
+            if self.next_tick > self.env.now:
+                yield self.env.timeout(self.next_tick - self.env.now)
             # Check for new targets from db
             # If new targets:
             #   Request nav update
             #   Get unclassified targets
             #   Organize targets with tsp
             #   Send plan
+            if resume is not None:
+                # Resumed from a snapshot taken in the middle of a planning cycle
+                yield from self.plan_cycle(*resume)
+                resume = None
+            elif self.new_targets:
+                # Targets come from add_target, later from a request to the DB
+                self.new_targets = False
+                yield from self.plan_cycle()
+            self.next_tick = self.env.now + self.planer_timeout
+
+    def plan_cycle(self, phase=None, until=None, msg=None):
+        """
+        Requests a navigation update, plans the unclassified targets and sends the plan once the simulated planning
+        time has passed. The current phase is kept in self.cycle so that a snapshot can resume the cycle.
+        :param phase: Phase to resume, 'nav' while waiting for the navigation update or 'plan' while computing.
+        :param until: End time of the phase to resume.
+        :param msg: Plan request of the 'plan' phase.
+        """
+        if phase is None:
+            self.got_nav = False
+            self.nav_req.put(NavReqMsg())
+            phase, until = 'nav', self.env.now + 1
+        if phase == 'nav':
+            self.cycle = (phase, until, None)
+            yield self.env.timeout(until - self.env.now)
+            self.cycle = None
             start = time.time()
-            new_targets = False
-            if DEBUG:
-                if first_time:
-                    new_targets = True
-                    first_time = False
+            target_ids = self.registry.unclassified_ids()
+            if len(target_ids) == 0:
+                return
+            target_list = [self.registry[i] for i in target_ids]
+
+            cache_key = self.plan_cache.key(target_ids, self.vehicle_pos)
+            cached_order = self.plan_cache.get(cache_key)
+            compute_time = 0
+            if cached_order is not None:
+                position = dict((k, i) for i, k in enumerate(target_ids))
+                target_order = [position[k] for k in cached_order]
+                if tracer.enabled & PLAN:
+                    tracer.emit(self.env.now, PLAN_CACHED, self.trace_id, len(target_ids))
+            elif self.background:
+                # The executor keeps executing the old plan until the job finishes
+                target_ids, distances = self.cost_matrix.matrix(self.vehicle_pos, target_ids)
+                self.plan_in_background(distances, target_ids, cache_key)
+                return
             else:
-                # Write request for new targets from DB
-                pass
-            if new_targets:
-                self.got_nav = False
-                self.nav_req.put(NavReqMsg())
-                yield self.env.timeout(1)
-                unclassified_targets = []
-                for i in range(len(self.targets_list)):
-                    if self.targets_list[i][1].classification == "None":
-                        unclassified_targets.append([i, self.targets_list[i][1]])
+                target_ids, distances = self.cost_matrix.matrix(self.vehicle_pos, target_ids)
+                tsp_route, total_cost, model = solve_ovrp(distances, engine=self.engine,
+                                                       keys=['vehicle'] + target_ids,
+                                                       warm_model=self.warm_model,
+                                                       time_limit=self.time_budget)
+                compute_time = self.compute_time(len(target_ids))
+                if tracer.enabled & PLAN:
+                    tracer.emit(self.env.now, PLAN_SOLVED, self.trace_id, len(target_ids), compute_time,
+                                time.time() - start)
 
-                if len(unclassified_targets) > 0:
-                    positions = []
-                    positions.append(self.vehicle_pos)
-                    target_list = []
-                    for i in range(len(unclassified_targets)):
-                        positions.append(unclassified_targets[i][1].ned_pos)
-                        target_list.append(unclassified_targets[i][1])
+                target_order = []
+                for i in range(1, len(tsp_route)):
+                    target_order.append(tsp_route[i] - 1)
+                self.plan_cache.put(cache_key, [target_ids[i] for i in target_order])
+            phase, until, msg = 'plan', self.env.now + compute_time, PlanReqMsg(target_list, target_order)
 
-                    n = len(positions)
-                    distances = np.zeros((n, n))
-                    positions = np.array(positions)
+        # The plan is ready once the simulated planning time has passed
+        self.cycle = (phase, until, msg)
+        yield self.env.timeout(until - self.env.now)
+        self.cycle = None
+        self.send_plan(msg)
 
-                    for k in xrange(n):
-                        for p in xrange(n):
-                            distances[k, p] = np.linalg.norm(positions[k, :] - positions[p, :])
 
-                    tsp_route, total_cost, model = ovrp_solver(distances)
 
-                    if DEBUG:
-                        print("OVRP Route: {0}".format(tsp_route))
 
-                    target_order = []
-                    for i in range(1, len(tsp_route)):
-                        target_order.append(tsp_route[i] - 1)
 
-                    if DEBUG:
-                        print(target_order)
-                        print(target_list)
+class FleetPlanner:
+    """
+    Planner for a fleet of vehicles. Unclassified targets are partitioned among the vehicles starting from the last
+    navigation update of each vehicle, the OVRP of every partition is solved in a process pool and one plan request
+    is sent to each vehicle. The pipes are lists with one pipe per vehicle, workers=0 solves the partitions in the
+    simulation process.
+    """
 
-                    self.plan_request.put(PlanReqMsg(target_list, target_order))
-                    if DEBUG:
-                        print("Computation: {0}".format(time.time() - start))
-                    yield self.env.timeout(time.time() - start)
+    planer_timeout = 100  # Planner rate 0.1 Hz to check.
+    engine = 'auto'  # OVRP engine, see ovrp_solver.ENGINES.
 
-            yield self.env.timeout(self.planer_timeout)
+    def __init__(self, env, plan_requests, plan_feedbacks, nav_reqs, nav_updates, targets=None, engine='auto',
+                 workers=None):
+        self.env = env
+        self.engine = engine
+        self.workers = workers
+        self.pool = None
+        self.plan_requests = plan_requests
+        self.plan_feedbacks = plan_feedbacks
+        self.nav_reqs = nav_reqs
+        self.nav_updates = nav_updates
+        self.n_vehicles = len(plan_requests)
+        self.vehicle_pos = [[0, 0, 0] for i in range(self.n_vehicles)]
+        for i in range(self.n_vehicles):
+            self.plan_feedbacks[i].subscribe(partial(self.handle_plan_feedback, i))
+            self.nav_updates[i].subscribe(partial(self.handle_nav_update, i))
+        self.registry = TargetRegistry()
+        self.new_targets = False
+        self.trace_id = tracer.intern("fleet_planner")
+        if targets is not None:
+            for pos in targets:
+                self.add_target(pos)
+        self.action = env.process(self.run())
+
+    def add_target(self, pos):
+        self.registry.add(pos)
+        self.new_targets = True
+
+    def handle_plan_feedback(self, vehicle, msg):
+        self.registry.classify(msg.target_id, msg.target_class)
+
+    def handle_nav_update(self, vehicle, msg):
+        self.vehicle_pos[vehicle] = msg.pos
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
 
+    def run(self):
+        while True:
+            if self.new_targets:
+                self.new_targets = False
+                for nav_req in self.nav_reqs:
+                    nav_req.put(NavReqMsg())
+                yield self.env.timeout(1)
+                target_list = self.registry.unclassified_targets()
 
+                if len(target_list) > 0:
+                    if self.pool is None and self.workers != 0:
+                        self.pool = ProcessPoolExecutor(self.workers)
+                    targets = np.array([t.ned_pos for t in target_list], dtype=float)
+                    orders = solve_fleet(targets, np.array(self.vehicle_pos, dtype=float), engine=self.engine,
+                                         pool=self.pool)
+                    for i in range(self.n_vehicles):
+                        # Each vehicle only gets its own targets
+                        vehicle_targets = [target_list[k] for k in orders[i]]
+                        for target in vehicle_targets:
+                            self.registry.assign(target.id)
+                        msg = PlanReqMsg(vehicle_targets, list(range(len(vehicle_targets))))
+                        if tracer.enabled & MSG:
+                            tracer.emit_message(self.env.now, MSG_SENT, self.trace_id, msg)
+                        self.plan_requests[i].put(msg)
+
+            yield self.env.timeout(self.planer_timeout)
 
 
 def main():
     # Simulation setup
     start = time.time()
     env = simpy.Environment()
+    tracer.enable(TRACE)
 
     # Process cabling
     plan_request = Pipe(env, 0)
@@ -148,14 +354,16 @@ def main():
     auv1 = AuvExecutor(env, "auv1", plan_request, plan_feedback, nav_req, nav_update)
     vehicle_planner = AuvPlanner(env, plan_request, plan_feedback, nav_req, nav_update)
 
-    fig, ax = plt.subplots()
-    ax = fig.add_subplot(111, projection='3d')
-    if PLOT:
-        env.process(position_printer(env, auv1, ax))
+    recorder = TrajectoryRecorder()
+    env.process(recorder.sampler(env, [auv1]))
     env.run(until=3600)
     print(time.time()-start)
+    recorder.save(TRACK_FILE)
+    tracer.save(TRACE_FILE)
     if PLOT:
+        import matplotlib.pyplot as plt
+        plot_tracks(recorder.track_dict())
         plt.show()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,174 @@
+__author__ = 'nick'
+
+# Profiling of the SimPy event dispatch. ProfiledEnvironment is a drop in replacement of simpy.Environment that times
+# every callback it runs and attributes it to the process generator (e.g. AuvExecutor.run) or the callback function
+# (e.g. AuvExecutor.handle_nav_req) behind it. Pipe and Topic subscriber handlers run inside the flush callback of the
+# pipe, they are wrapped when they subscribe and timed as callbacks of their own, the flush keeps only its own time.
+# Scheduled events are attributed to the process or callback that was running when they were scheduled. The result is a sorted report and a folded stack dump that flamegraph.pl or
+# speedscope read directly.
+
+import argparse
+import os
+import time
+from heapq import heappop
+import simpy
+from simpy.core import EmptySchedule, StopSimulation
+from simpy.events import Process
+
+TOP_LEVEL = 'simulation'  # Key of the events scheduled outside of any callback, e.g. by the setup code
+
+
+def callback_key(callback):
+    """
+    :return: The name a callback is attributed to, 'module:qualified name' of the process generator for process
+    resumes and of the function otherwise.
+    """
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, Process):
+        generator = owner._generator
+        module = os.path.splitext(os.path.basename(generator.gi_code.co_filename))[0]
+        return '%s:%s' % (module, generator.__qualname__)
+    func = getattr(callback, 'func', callback)  # functools.partial
+    return '%s:%s' % (getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)))
+
+
+class ProfiledEnvironment(simpy.Environment):
+    """
+    Environment whose step() counts and times the callbacks of every event. It uses the same internals as
+    simpy.Environment.step, the event queue and the event state, and costs two clock reads and a dictionary update
+    per callback.
+    """
+
+    def __init__(self, initial_time=0):
+        simpy.Environment.__init__(self, initial_time)
+        self.events = 0
+        self.callbacks = {}  # key -> number of calls
+        self.times = {}  # key -> total wall time of the calls
+        self.scheduled = {}  # key -> number of events scheduled while the key was running
+        self.current = TOP_LEVEL
+        self.nested = 0.0  # Time of the handlers called by the running callback, excluded from its time
+
+    def schedule(self, event, priority=simpy.events.NORMAL, delay=0):
+        self.scheduled[self.current] = self.scheduled.get(self.current, 0) + 1
+        simpy.Environment.schedule(self, event, priority, delay)
+
+    def wrap_handler(self, handler):
+        """
+        Wraps a subscriber handler so that its calls are counted and timed under its own key. Called by
+        Pipe.subscribe through pipe.wrap_handler.
+        """
+        key = callback_key(handler)
+        clock = time.perf_counter
+
+        def __call(*args):
+            parent, outer = self.current, self.nested
+            self.current = key
+            self.nested = 0.0
+            st = clock()
+            try:
+                return handler(*args)
+            finally:
+                dt = clock() - st
+                self.times[key] = self.times.get(key, 0.0) + dt - self.nested
+                self.callbacks[key] = self.callbacks.get(key, 0) + 1
+                self.current = parent
+                self.nested = outer + dt
+        return __call
+
+    def step(self):
+        try:
+            self._now, _, _, event = heappop(self._queue)
+        except IndexError:
+            raise EmptySchedule()
+        self.events += 1
+
+        callbacks, event.callbacks = event.callbacks, None
+        clock = time.perf_counter
+        for k, callback in enumerate(callbacks):
+            key = callback_key(callback)
+            self.current = key
+            self.nested = 0.0
+            st = clock()
+            try:
+                callback(event)
+            except StopSimulation:
+                # Same as simpy.Environment.step, run the remaining callbacks when the simulation resumes
+                event.callbacks = callbacks[k + 1:]
+                simpy.Environment.schedule(self, event, -1)
+                raise
+            finally:
+                self.times[key] = self.times.get(key, 0.0) + clock() - st - self.nested
+                self.callbacks[key] = self.callbacks.get(key, 0) + 1
+                self.current = TOP_LEVEL
+
+        if not event._ok and not hasattr(event, '_defused'):
+            exc = type(event._value)(*event._value.args)
+            exc.__cause__ = event._value
+            raise exc
+
+    def stats(self):
+        """
+        :return: A list of (key, callbacks, events scheduled, total time) sorted by decreasing total time.
+        """
+        keys = set(self.callbacks) | set(self.scheduled)
+        rows = [(key, self.callbacks.get(key, 0), self.scheduled.get(key, 0), self.times.get(key, 0.0))
+                for key in keys]
+        rows.sort(key=lambda r: (-r[3], -r[1]))
+        return rows
+
+    def report(self, limit=None):
+        """
+        :param limit: Optional number of rows.
+        :return: The lines of a report sorted by total time.
+        """
+        rows = self.stats()
+        total = sum(r[3] for r in rows)
+        lines = ['%d events, %.3f secs in callbacks' % (self.events, total),
+                 '%-60s %10s %10s %10s %10s %6s' % ('callback', 'calls', 'scheduled', 'total ms', 'mean us', '%')]
+        for key, calls, scheduled, t in rows[:limit]:
+            lines.append('%-60s %10d %10d %10.2f %10.2f %6.1f' % (
+                key, calls, scheduled, 1e3 * t, 1e6 * t / calls if calls > 0 else 0.0,
+                100 * t / total if total > 0 else 0.0))
+        return lines
+
+    def folded(self):
+        """
+        :return: The callback times as folded stacks, 'module;qualified;name microseconds' per line.
+        """
+        lines = []
+        for key, calls, scheduled, t in self.stats():
+            if calls > 0:
+                module, name = key.split(':', 1)
+                lines.append('%s;%s;%s %d' % (TOP_LEVEL, module, name.replace('.', ';'), round(1e6 * t)))
+        return lines
+
+    def save_folded(self, path):
+        with open(path, 'w') as f:
+            for line in self.folded():
+                f.write(line + '\n')
+
+
+def main():
+    from bench_sim import SCENARIOS, build
+
+    parser = argparse.ArgumentParser(description='Profile the event dispatch of a simulation scenario.')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='generator')
+    parser.add_argument('--vehicles', type=int, default=10)
+    parser.add_argument('--targets', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=24 * 3600)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--folded', default='sim_profile.folded', help='Folded stack output for flame graphs.')
+    args = parser.parse_args()
+
+    env = ProfiledEnvironment()
+    build(env, args.scenario, args.vehicles, args.targets, 10.0, 0)
+    st = time.time()
+    env.run(until=args.duration)
+    print('Simulated %g secs in %.3f secs' % (args.duration, time.time() - st))
+    for line in env.report(args.limit):
+        print(line)
+    env.save_folded(args.folded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+__author__ = 'nick'
+
+# Structured tracing for the simulations. Typed events are written into a fixed size binary ring buffer instead of
+# being printed, and every category can be enabled separately. Call sites test the category mask before emitting:
+#
+#     if tracer.enabled & STATE:
+#         tracer.emit(env.now, STATE_CHANGE, source, old_state, new_state)
+#
+# so a disabled category costs one attribute lookup and an and. The trace is exported after the run with save() or
+# printed with dump().
+
+import sys
+import numpy as np
+
+# Categories, bit flags of the enabled mask
+STATE = 1
+MSG = 2
+INSPECT = 4
+PLAN = 8
+NAV = 16
+ALL = STATE | MSG | INSPECT | PLAN | NAV
+
+# Event kinds and the meaning of their payload (a, b, c)
+STATE_CHANGE = 0  # old state, new state
+MSG_SENT = 1  # message type id, target id, plan length or number of plan operations
+MSG_RECEIVED = 2  # message type id, target id, plan length or number of plan operations
+INSPECT_START = 3  # target id
+INSPECT_END = 4  # target id
+PLAN_SOLVED = 5  # number of targets, simulated compute time, wall clock time
+PLAN_CACHED = 6  # number of targets
+NAV_UPDATE = 7  # north, east, down
+
+CATEGORY = {STATE_CHANGE: STATE, MSG_SENT: MSG, MSG_RECEIVED: MSG, INSPECT_START: INSPECT, INSPECT_END: INSPECT,
+            PLAN_SOLVED: PLAN, PLAN_CACHED: PLAN, NAV_UPDATE: NAV}
+KIND_NAMES = {STATE_CHANGE: 'state', MSG_SENT: 'sent', MSG_RECEIVED: 'received', INSPECT_START: 'inspect_start',
+              INSPECT_END: 'inspect_end', PLAN_SOLVED: 'plan_solved', PLAN_CACHED: 'plan_cached', NAV_UPDATE: 'nav'}
+
+RECORD = np.dtype([('t', 'f8'), ('kind', 'u1'), ('source', 'u2'), ('a', 'f8'), ('b', 'f8'), ('c', 'f8')])
+
+
+class Tracer:
+    """
+    Ring buffer of trace records. When the buffer is full the oldest records are overwritten. Sources and message
+    types are stored as ids of an interned name table.
+    """
+
+    def __init__(self, capacity=65536, categories=0):
+        self.enabled = categories
+        self.buffer = np.zeros(capacity, dtype=RECORD)
+        self.count = 0  # Records emitted since the last clear, including the overwritten ones
+        self.names = []
+        self.name_ids = {}
+
+    def enable(self, categories=ALL):
+        self.enabled |= categories
+
+    def disable(self, categories=ALL):
+        self.enabled &= ~categories
+
+    def intern(self, name):
+        """
+        :return: The id of the name in the name table.
+        """
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(name)
+            self.name_ids[name] = name_id
+        return name_id
+
+    def emit(self, t, kind, source, a=0.0, b=0.0, c=0.0):
+        """
+        Writes a record. Callers check the category of the event against enabled first.
+        :param t: Simulation time.
+        :param kind: Event kind, e.g. STATE_CHANGE.
+        :param source: Interned id of the emitting component.
+        :param a: First payload value.
+        :param b: Second payload value.
+        :param c: Third payload value.
+        """
+        self.buffer[self.count % len(self.buffer)] = (t, kind, source, a, b, c)
+        self.count += 1
+
+    def emit_message(self, t, kind, source, msg):
+        """
+        Writes a MSG_SENT or MSG_RECEIVED record for a message object.
+        """
+        self.emit(t, kind, source, self.intern(type(msg).__name__), message_arg(msg))
+
+    @property
+    def dropped(self):
+        return max(0, self.count - len(self.buffer))
+
+    def records(self):
+        """
+        :return: The records in the buffer from oldest to newest.
+        """
+        capacity = len(self.buffer)
+        if self.count <= capacity:
+            return self.buffer[:self.count].copy()
+        i = self.count % capacity
+        return np.concatenate((self.buffer[i:], self.buffer[:i]))
+
+    def clear(self):
+        self.count = 0
+
+    def save(self, path):
+        """
+        Writes the records and the name table to a compressed .npz file.
+        """
+        np.savez_compressed(path, records=self.records(), names=np.array(self.names, dtype=str),
+                            dropped=self.dropped)
+
+    def dump(self, out=None):
+        for line in format_records(self.records(), self.names):
+            print(line, file=out if out is not None else sys.stdout)
+
+
+def message_arg(msg):
+    """
+    :return: The number that identifies the content of a message in the trace.
+    """
+    if hasattr(msg, 'target_id'):
+        return msg.target_id
+    if hasattr(msg, 'target_order'):
+        return len(msg.target_order)
+    if hasattr(msg, 'ops'):
+        return len(msg.ops)
+    return 0
+
+
+def load_trace(path):
+    """
+    Reads a trace written by Tracer.save.
+    :return: The records and the name table.
+    """
+    data = np.load(path)
+    return data['records'], [str(name) for name in data['names']]
+
+
+def format_records(records, names):
+    """
+    :return: One human readable line per record.
+    """
+    lines = []
+    for r in records:
+        kind = int(r['kind'])
+        source = names[r['source']] if r['source'] < len(names) else r['source']
+        if kind in (MSG_SENT, MSG_RECEIVED):
+            payload = "{0} {1:g}".format(names[int(r['a'])], r['b'])
+        else:
+            payload = "{0:g} {1:g} {2:g}".format(r['a'], r['b'], r['c'])
+        lines.append("{0:10.2f} {1:<8} {2:<14} {3}".format(r['t'], source, KIND_NAMES.get(kind, kind), payload))
+    return lines
+
+
+# Tracer shared by the simulation modules. It is configured in place, enable() / disable(), and never replaced, so
+# modules can import it by name.
+tracer = Tracer()
+
+
+def main():
+    records, names = load_trace(sys.argv[1])
+    for line in format_records(records, names):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
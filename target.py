@@ -2,12 +2,17 @@ __author__ = 'nick'
 
 # Simple target class.
 
+UNCLASSIFIED = "None"
+
 
 class Target:
     id = 0
-    classification = "None"
+    classification = UNCLASSIFIED
     ned_pos = [0, 0, 0]
 
     def __init__(self, uid, pos):
         self.id = uid
         self.ned_pos = pos
+
+    def is_classified(self):
+        return self.classification != UNCLASSIFIED
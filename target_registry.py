@@ -0,0 +1,142 @@
+__author__ = 'nick'
+
+# Target bookkeeping. The status of every target is kept in a compact array and the set of unclassified targets is
+# maintained incrementally, so the cost per tick does not depend on how many targets were already classified.
+
+from collections import OrderedDict
+import numpy as np
+
+from target import Target
+from msgs import PLAN_INSERT, PLAN_REMOVE, PLAN_REORDER
+
+# Target status
+STATUS_UNCLASSIFIED = 0
+STATUS_CLASSIFIED = 1
+STATUS_ASSIGNED = 2
+
+
+class TargetRegistry:
+    """
+    Targets indexed by id. Ids are assigned in order starting from 0.
+    """
+
+    def __init__(self, capacity=64):
+        self.targets = []
+        self.status = np.zeros(capacity, dtype=np.int8)
+        self.unclassified = OrderedDict()  # Ordered set of the unclassified target ids
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, target_id):
+        return self.targets[target_id]
+
+    def add(self, pos):
+        """
+        Creates a new unclassified target.
+        :param pos: NED position of the target.
+        :return: The target.
+        """
+        target = Target(len(self.targets), pos)
+        if target.id == len(self.status):
+            self.status = np.resize(self.status, 2 * len(self.status))
+        self.status[target.id] = STATUS_UNCLASSIFIED
+        self.targets.append(target)
+        self.unclassified[target.id] = True
+        return target
+
+    def classify(self, target_id, classification):
+        self.targets[target_id].classification = classification
+        self.status[target_id] = STATUS_CLASSIFIED
+        self.unclassified.pop(target_id, None)
+
+    def assign(self, target_id):
+        if self.status[target_id] == STATUS_UNCLASSIFIED:
+            self.status[target_id] = STATUS_ASSIGNED
+
+    def is_classified(self, target_id):
+        return self.status[target_id] == STATUS_CLASSIFIED
+
+    def unclassified_ids(self):
+        """
+        :return: Ids of the unclassified (including assigned) targets in the order they were added.
+        """
+        return list(self.unclassified.keys())
+
+    def unclassified_targets(self):
+        return [self.targets[i] for i in self.unclassified]
+
+
+class PlanCursor:
+    """
+    Position in a plan. The next unclassified target is found by moving the cursor forward instead of popping the
+    front of the order list, every target is skipped at most once. The cursor works on copies of the lists it is
+    given, a message can be shared by several subscribers.
+    """
+
+    def __init__(self, target_list=None, target_order=None):
+        self.target_list = list(target_list) if target_list is not None else []
+        self.target_order = list(target_order) if target_order is not None else []
+        self.index = 0
+        self.list_index = dict((t.id, i) for i, t in enumerate(self.target_list))  # Target id -> index in the list
+
+    def __len__(self):
+        return len(self.target_order) - self.index
+
+    def _position(self, target_id):
+        # Position of a target in the remaining part of the order, None if the cursor already passed it
+        try:
+            return self.target_order.index(self.list_index[target_id], self.index)
+        except ValueError:
+            return None
+
+    def insert(self, target, after_id=None):
+        """
+        Inserts a target in the remaining plan.
+        :param target: The target, added to the target list if it is not there yet.
+        :param after_id: Id of the target it follows, None to make it the next target. A target the cursor already
+        passed counts as None.
+        """
+        i = self.list_index.get(target.id)
+        if i is None:
+            i = len(self.target_list)
+            self.target_list.append(target)
+            self.list_index[target.id] = i
+        position = self._position(after_id) if after_id is not None else None
+        self.target_order.insert(self.index if position is None else position + 1, i)
+
+    def remove(self, target_id):
+        position = self._position(target_id)
+        if position is not None:
+            del self.target_order[position]
+
+    def reorder(self, target_ids):
+        """
+        Replaces the remaining plan by the targets in the given order.
+        """
+        self.target_order[self.index:] = [self.list_index[k] for k in target_ids]
+
+    def apply(self, ops):
+        """
+        Applies the operations of a PlanDeltaMsg in order.
+        """
+        for op in ops:
+            if op[0] == PLAN_INSERT:
+                self.insert(op[1], op[2])
+            elif op[0] == PLAN_REMOVE:
+                self.remove(op[1])
+            elif op[0] == PLAN_REORDER:
+                self.reorder(op[1])
+            else:
+                raise ValueError("Unknown plan operation {0}".format(op[0]))
+
+    def next_unclassified(self):
+        """
+        :return: The next target of the plan that is not classified or None if the plan is finished.
+        """
+        while self.index < len(self.target_order):
+            target = self.target_list[self.target_order[self.index]]
+            if not target.is_classified():
+                return target
+            self.index += 1
+        return None
@@ -0,0 +1,155 @@
+__author__ = 'nick'
+
+# Analytic vehicle trajectories. The motion of a vehicle is stored as a list of typed segments (rotate or translate)
+# with their start/end times and poses, so the pose at any time is a closed form evaluation instead of an
+# interpolation over the current action.
+
+from bisect import bisect_right
+from collections import namedtuple
+import math
+import numpy as np
+
+# Segment types
+ROTATE = 0
+TRANSLATE = 1
+
+# A pose is [north, east, down, yaw]. The yaw of the end pose is not wrapped so that interpolation follows the turn.
+Segment = namedtuple('Segment', ['kind', 't0', 't1', 'pose0', 'pose1'])
+
+
+def wrap_angle(angle):
+    return (np.asarray(angle) + math.pi) % (2 * math.pi) - math.pi
+
+
+class Trajectory:
+    """
+    Growable array of trajectory segments of a single vehicle. Segments have to be added in time order.
+    """
+
+    def __init__(self, pose=(0, 0, 0, 0), t=0.0, capacity=16):
+        self.initial_pose = np.array(pose, dtype=float)
+        self.initial_time = t
+        self.size = 0
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.times = np.zeros((capacity, 2))
+        self.poses = np.zeros((capacity, 2, 4))
+        self._t0 = []  # Start times as a list for bisect
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        capacity = 2 * len(self.kind)
+        self.kind = np.resize(self.kind, capacity)
+        self.times = np.resize(self.times, (capacity, 2))
+        self.poses = np.resize(self.poses, (capacity, 2, 4))
+
+    def add(self, kind, t0, t1, pose0, pose1):
+        """
+        Appends a segment.
+        :param kind: ROTATE or TRANSLATE.
+        :param t0: Start time.
+        :param t1: End time.
+        :param pose0: Pose at the start [north, east, down, yaw].
+        :param pose1: Pose at the end [north, east, down, yaw].
+        """
+        if self.size == len(self.kind):
+            self._grow()
+        i = self.size
+        self.kind[i] = kind
+        self.times[i] = (t0, t1)
+        self.poses[i, 0] = pose0
+        self.poses[i, 1] = pose1
+        self._t0.append(t0)
+        self.size += 1
+
+    def rotate(self, t0, duration, pose, angle):
+        pose1 = np.array(pose, dtype=float)
+        pose1[3] += angle
+        self.add(ROTATE, t0, t0 + duration, pose, pose1)
+
+    def translate(self, t0, duration, pose, pos):
+        pose1 = np.array(pose, dtype=float)
+        pose1[:3] = pos
+        self.add(TRANSLATE, t0, t0 + duration, pose, pose1)
+
+    def truncate(self, t):
+        """
+        Cuts the last segment at time t, e.g. when the action is interrupted.
+        """
+        if self.size > 0 and self.times[self.size - 1, 1] > t:
+            i = self.size - 1
+            self.poses[i, 1] = self._interpolate(i, t)
+            self.times[i, 1] = max(t, self.times[i, 0])
+
+    def segment(self, i):
+        return Segment(int(self.kind[i]), self.times[i, 0], self.times[i, 1], self.poses[i, 0], self.poses[i, 1])
+
+    def segments(self):
+        return [self.segment(i) for i in range(self.size)]
+
+    def _interpolate(self, i, t):
+        t0, t1 = self.times[i]
+        frac = (t - t0) / (t1 - t0) if t1 > t0 else 1.0
+        frac = min(max(frac, 0.0), 1.0)
+        return self.poses[i, 0] + frac * (self.poses[i, 1] - self.poses[i, 0])
+
+    def pose_at(self, t):
+        """
+        :param t: Time of the query.
+        :return: The pose [north, east, down, yaw] at time t.
+        """
+        i = bisect_right(self._t0, t) - 1
+        if i < 0:
+            return self.initial_pose.copy()
+        pose = self._interpolate(i, t)
+        pose[3] = wrap_angle(pose[3])
+        return pose
+
+    def position_at(self, t):
+        return self.pose_at(t)[:3]
+
+    def poses_at(self, ts):
+        """
+        Batch evaluation of many timestamps.
+        :param ts: Array of times.
+        :return: Array of shape (len(ts), 4) with the poses.
+        """
+        ts = np.asarray(ts, dtype=float)
+        idx = np.searchsorted(self.times[:self.size, 0], ts, side='right') - 1
+        poses = np.tile(self.initial_pose, (len(ts), 1))
+        valid = idx >= 0
+        i = idx[valid]
+        t0 = self.times[i, 0]
+        duration = self.times[i, 1] - t0
+        frac = np.clip((ts[valid] - t0) / np.where(duration > 0, duration, 1.0), 0.0, 1.0)
+        frac[duration <= 0] = 1.0
+        poses[valid] = self.poses[i, 0] + frac[:, np.newaxis] * (self.poses[i, 1] - self.poses[i, 0])
+        poses[:, 3] = wrap_angle(poses[:, 3])
+        return poses
+
+
+def poses_at(trajectories, t):
+    """
+    Batch evaluation of many trajectories at the same time.
+    :param trajectories: List of Trajectory.
+    :param t: Time of the query.
+    :return: Array of shape (len(trajectories), 4) with the poses.
+    """
+    n = len(trajectories)
+    pose0 = np.zeros((n, 4))
+    pose1 = np.zeros((n, 4))
+    frac = np.ones(n)
+    for k, traj in enumerate(trajectories):
+        i = bisect_right(traj._t0, t) - 1
+        if i < 0:
+            pose0[k] = pose1[k] = traj.initial_pose
+        else:
+            pose0[k], pose1[k] = traj.poses[i]
+            t0, t1 = traj.times[i]
+            if t1 > t0:
+                frac[k] = (t - t0) / (t1 - t0)
+    frac = np.clip(frac, 0.0, 1.0)
+    poses = pose0 + frac[:, np.newaxis] * (pose1 - pose0)
+    poses[:, 3] = wrap_angle(poses[:, 3])
+    return poses
@@ -0,0 +1,131 @@
+__author__ = 'nick'
+
+# Records vehicle poses during a simulation into growable NumPy buffers and writes them to a compressed .npz file.
+# Plotting is a separate offline step so that simulations can run headless.
+
+import numpy as np
+
+
+class TrajectoryRecorder:
+    """
+    Per vehicle buffers of (time, north, east, down) samples.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.times = {}
+        self.poses = {}
+        self.sizes = {}
+
+    def names(self):
+        return list(self.times.keys())
+
+    def _grow(self, name):
+        capacity = 2 * len(self.times[name])
+        self.times[name] = np.resize(self.times[name], capacity)
+        self.poses[name] = np.resize(self.poses[name], (capacity, 3))
+
+    def record(self, name, t, pos):
+        """
+        Appends a sample.
+        :param name: Name of the vehicle.
+        :param t: Time of the sample.
+        :param pos: NED position.
+        """
+        if name not in self.times:
+            self.times[name] = np.zeros(self.capacity)
+            self.poses[name] = np.zeros((self.capacity, 3))
+            self.sizes[name] = 0
+        i = self.sizes[name]
+        if i == len(self.times[name]):
+            self._grow(name)
+        self.times[name][i] = t
+        self.poses[name][i] = pos[:3]
+        self.sizes[name] = i + 1
+
+    def track(self, name):
+        """
+        :return: The times and positions recorded for the vehicle.
+        """
+        n = self.sizes[name]
+        return self.times[name][:n], self.poses[name][:n]
+
+    def track_dict(self):
+        """
+        :return: A dictionary from vehicle name to (times, positions), like load_tracks.
+        """
+        return dict((name, self.track(name)) for name in self.names())
+
+    def sampler(self, env, vehicles, period=10, skip_unchanged=True):
+        """
+        SimPy process that samples the position of the vehicles periodically.
+        :param env: SimPy environment.
+        :param vehicles: List of vehicles with a name and a get_position() method.
+        :param period: Sampling period in seconds.
+        :param skip_unchanged: Do not record a sample if the vehicle has not moved since the last one.
+        """
+        while True:
+            for veh in vehicles:
+                pos = veh.get_position()
+                n = self.sizes.get(veh.name, 0)
+                if not skip_unchanged or n == 0 or not np.array_equal(self.poses[veh.name][n - 1], pos):
+                    self.record(veh.name, env.now, pos)
+            yield env.timeout(period)
+
+    def save(self, path):
+        """
+        Writes all tracks to a compressed .npz file.
+        """
+        arrays = {}
+        names = self.names()
+        for k, name in enumerate(names):
+            t, pos = self.track(name)
+            arrays['t%d' % k] = t
+            arrays['pos%d' % k] = pos
+        np.savez_compressed(path, names=np.array(names), **arrays)
+
+
+def load_tracks(path):
+    """
+    Reads the tracks written by TrajectoryRecorder.save.
+    :return: A dictionary from vehicle name to (times, positions).
+    """
+    data = np.load(path)
+    return dict((str(name), (data['t%d' % k], data['pos%d' % k])) for k, name in enumerate(data['names']))
+
+
+def plot_tracks(tracks, ax=None):
+    """
+    Plots every track in one call per vehicle on a 3D axis (East, North, Depth).
+    :param tracks: Dictionary returned by load_tracks or the path of a .npz file.
+    :param ax: Optional 3D axis.
+    :return: The axis.
+    """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D
+
+    if not isinstance(tracks, dict):
+        tracks = load_tracks(tracks)
+    if ax is None:
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
+    ax.set_xlabel("East")
+    ax.set_ylabel("North")
+    ax.set_zlabel("Depth")
+    ax.grid(True)
+    for name, (t, pos) in tracks.items():
+        ax.plot(pos[:, 1], pos[:, 0], pos[:, 2], 'o-', label=name)
+    ax.legend()
+    return ax
+
+
+def main():
+    import sys
+    import matplotlib.pyplot as plt
+
+    plot_tracks(sys.argv[1])
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()